@@ -1,27 +1,79 @@
 from aiohttp.web import Application, run_app
 from dotenv import load_dotenv
-from .utils import middlewares
 import logging
 import os
 
+# before .utils: several of its modules read their settings at import
 load_dotenv(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config', '.env'))
 
+from .utils import middlewares, TokenFile
+
 
 class Settings:
   SERVER_TOKEN_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config', '.uuid')
   
   def __init__(self):
-    self.SERVER_TOKEN = self._load_contents(self.SERVER_TOKEN_FILE)
-    
-  @staticmethod
-  def _load_contents(filepath):
-    with open(filepath, 'r', encoding='utf-8') as f:
-      return f.read().strip()
+    self.tokens = TokenFile(self.SERVER_TOKEN_FILE)
+
+  @property
+  def SERVER_TOKEN(self):
+    return self.tokens.first
 
 settings = Settings()
 
+async def _stats_ctx(app: Application):
+  from .utils import Stats, STATS, LEADER
+  app[STATS] = Stats()
+  app[LEADER].add(app[STATS].keep_history)
+  # with several workers only the leader samples, the others forward the stats routes to it
+  if app[LEADER].routes: app[LEADER].add(app[STATS].start)
+  else: await app[STATS].start(app)
+  yield
+  await app[STATS].stop(app)
+
+
+async def _metrics_ctx(app: Application):
+  from .utils import METRICS
+  await METRICS.start(app)
+  yield
+  await METRICS.stop(app)
+
+
+async def _wireguard_ctx(app: Application):
+  from .modules.wg import WireGuard
+  from .modules.reconciler import Reconciler
+  from .modules.idle import IdleScheduler
+  from .utils import STATS, LEADER, WG, RECONCILER, IDLE
+  wg = app[WG] = WireGuard()
+  app[RECONCILER] = Reconciler(wg, stats=app[STATS])
+  app[IDLE] = IdleScheduler(wg, stats=app[STATS])
+  await wg.start(app)
+  app[LEADER].add(wg.rebuild_pool)
+  app[LEADER].add(app[RECONCILER].start, app[RECONCILER].stop)
+  app[LEADER].add(app[IDLE].start, app[IDLE].stop)
+  yield
+  await wg.stop(app)
+
+
+async def _squid_ctx(app: Application):
+  from .modules.squid import SquidManager
+  from .utils import LEADER, SQUID
+  app[SQUID] = SquidManager()
+  app[LEADER].add(app[SQUID].start, app[SQUID].stop)
+  yield
+
+
+async def _leader_ctx(app: Application):
+  """ Last, so every subsystem has registered its singleton jobs; those stop first on cleanup """
+  from .utils import LEADER
+  await app[LEADER].start(app)
+  yield
+  await app[LEADER].stop(app)
+
+
 def create_app() -> Application:
-  from .routes import rts
+  from .routes import rts, leader_rts
+  from .utils import Leadership, LEADER
   app = Application(middlewares=middlewares)
   logging.basicConfig(
     level=logging.INFO, filename='logs/client.log',
@@ -29,15 +81,24 @@ def create_app() -> Application:
     datefmt="%Y-%m-%d %H:%M:%S",
   )
   app.add_routes(rts)
+  # subsystems are imported and built at startup, in every worker, and torn down in reverse
+  workers = int(os.getenv('WEB_WORKERS', 1))
+  app[LEADER] = Leadership(routes=leader_rts if workers > 1 else ())
+  app.cleanup_ctx.extend([_stats_ctx, _metrics_ctx, _wireguard_ctx, _squid_ctx, _leader_ctx])
   return app
 
 
 def run():
-  app = create_app()
-  print('Starting client..')
-  run_app(
-    app,
+  """ WEB_WORKERS > 1 forks that many workers sharing the port through SO_REUSEPORT """
+  workers = int(os.getenv('WEB_WORKERS', 1))
+  serve = lambda: run_app(
+    create_app(),
     host='0.0.0.0',
     port=int(os.getenv('WEB_PORT')),
+    reuse_port=workers > 1,
     access_log_format='%{X-Forwarded-For}i %s - "%r" (%b | %D) %{User-Agent}i'
   )
+  print('Starting client..')
+  if workers <= 1: return serve()
+  from .utils.prefork import prefork
+  prefork(serve, workers)
@@ -1 +1,2 @@
 from .config import Config
+from .archive import ArchiveStream
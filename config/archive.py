@@ -0,0 +1,112 @@
+import tarfile
+import struct
+import time
+import zlib
+import io
+
+_LOCAL = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END = struct.Struct('<IHHHHIIH')
+_END64 = struct.Struct('<IQHHIIQQQQ')
+_LOCATOR64 = struct.Struct('<IIQI')
+_UTF8 = 0x0800
+
+
+class _Sink:
+  """ Write-only file object; tarfile streams into it """
+  def __init__(self) -> None:
+    self.chunks: list[bytes] = []
+
+  def write(self, data) -> int:
+    self.chunks.append(bytes(data))
+    return len(data)
+
+  def flush(self) -> None:
+    pass
+
+  def drain(self) -> bytes:
+    data, self.chunks = b''.join(self.chunks), []
+    return data
+
+
+class _ZipWriter:
+  """ Forward-only zip: every entry is deflated whole, so sizes and CRC go straight into the
+  local header. The central directory is kept as packed records (~60 bytes per entry);
+  ZIP64 end records are written past 65535 entries. """
+  def __init__(self, date_time: tuple) -> None:
+    y, mo, d, h, mi, s = date_time
+    self.dos_time, self.dos_date = (h << 11) | (mi << 5) | (s // 2), ((y - 1980) << 9) | (mo << 5) | d
+    self.sink = _Sink()
+    self.central = bytearray()
+    self.count = 0
+    self.offset = 0
+
+  def add(self, name: str, data: bytes) -> None:
+    if self.offset > 0xFFFFFFFF: raise ValueError('Zip export is limited to 4 GiB')
+    packer = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = packer.compress(data) + packer.flush()
+    crc, filename = zlib.crc32(data), name.encode()
+    header = _LOCAL.pack(0x04034b50, 20, _UTF8, 8, self.dos_time, self.dos_date, crc, len(compressed), len(data), len(filename), 0)
+    self.central += _CENTRAL.pack(
+      0x02014b50, (3 << 8) | 20, 20, _UTF8, 8, self.dos_time, self.dos_date, crc, len(compressed), len(data),
+      len(filename), 0, 0, 0, 0, 0o100600 << 16, self.offset,
+    ) + filename
+    self.sink.write(header + filename + compressed)
+    self.offset += len(header) + len(filename) + len(compressed)
+    self.count += 1
+
+  def close(self) -> None:
+    start, size = self.offset, len(self.central)
+    self.sink.write(self.central)
+    self.central = bytearray()
+    if self.count > 0xFFFF or start + size > 0xFFFFFFFF:
+      end64 = start + size
+      self.sink.write(_END64.pack(0x06064b50, _END64.size - 12, 45, 45, 0, 0, self.count, self.count, size, start))
+      self.sink.write(_LOCATOR64.pack(0x07064b50, 0, end64, 1))
+      self.sink.write(_END.pack(0x06054b50, 0, 0, 0xFFFF, 0xFFFF, min(size, 0xFFFFFFFF), 0xFFFFFFFF, 0))
+    else:
+      self.sink.write(_END.pack(0x06054b50, 0, 0, self.count, self.count, size, start, 0))
+
+
+class ArchiveStream:
+  """ Builds a zip (or tar.gz) incrementally: `add` files, `drain` what is ready to send,
+  `close` for the trailer. Only the pending chunk and the zip's packed central directory are kept. """
+  FORMATS = {'zip': 'application/zip', 'tar': 'application/gzip'}
+  EXTENSIONS = {'zip': 'zip', 'tar': 'tar.gz'}
+
+  def __init__(self, format: str = 'zip') -> None:
+    if format not in self.FORMATS: raise ValueError(f'Unsupported archive format: {format}')
+    self.format = format
+    self.mtime = time.time()
+    if format == 'zip':
+      self.archive = _ZipWriter(time.localtime(self.mtime)[:6])
+      self.sink = self.archive.sink
+    else:
+      self.sink = _Sink()
+      self.archive = tarfile.open(fileobj=self.sink, mode='w|gz')
+
+  @property
+  def content_type(self) -> str:
+    return self.FORMATS[self.format]
+
+  @property
+  def extension(self) -> str:
+    return self.EXTENSIONS[self.format]
+
+  def add(self, name: str, text: str) -> None:
+    data = text.encode()
+    if self.format == 'zip':
+      self.archive.add(name, data)
+      return
+    info = tarfile.TarInfo(name)
+    info.size, info.mtime, info.mode = len(data), int(self.mtime), 0o600
+    self.archive.addfile(info, io.BytesIO(data))
+    # a streamed tar needs no member index
+    self.archive.members.clear()
+
+  def drain(self) -> bytes:
+    return self.sink.drain()
+
+  def close(self) -> bytes:
+    self.archive.close()
+    return self.sink.drain()
@@ -1,8 +1,11 @@
 from zipfile import ZipFile, ZIP_DEFLATED
+from string import Formatter
 import os
 
 
 class Config:
+  _templates: dict[str, list[tuple[str, str | None]]] = {}
+
   priv: str = None
   ip_addr: str = None
   srv_pub: str = None
@@ -22,6 +25,18 @@ class Config:
     filepath = os.path.join(os.path.abspath(os.path.dirname(__file__)), f'{filename}.config')
     with open(filepath, 'r') as f:
       return f.read()
+
+  @classmethod
+  def _template(cls, filename) -> list[tuple[str, str | None]]:
+    """ Sample split once into (literal, field) pairs """
+    template = cls._templates.get(filename)
+    if template is None:
+      template = cls._templates[filename] = [(literal, field) for literal, field, _, _ in Formatter().parse(cls._load_sample(filename))]
+    return template
+
+  def render(self, filename: str = 'client') -> str:
+    values = self.__dict__
+    return ''.join(literal + (str(values[field]) if field is not None else '') for literal, field in self._template(filename))
     
   @staticmethod
   def _create_allowed(ip_addr):
@@ -29,15 +44,15 @@ class Config:
     
   @property
   def config(self) -> str:
-    return self._load_sample('client').format(**self.__dict__)
+    return self.render('client')
     
+  @staticmethod
   def zip(filepath) -> str:
+    user_config = os.path.join(filepath, 'wg.conf')
+    if not os.path.exists(user_config):
+      raise FileNotFoundError(user_config)
     with ZipFile(f'{filepath}/wg.zip', 'w', ZIP_DEFLATED) as zfile:
-      user_config = os.path.join(filepath, 'wg.conf')
-      if not os.path.exists(user_config):
-        raise FileNotFoundError(user_config)
-      filename = os.path.basename(user_config)
-      zfile.write(filepath, arcname=filename)
+      zfile.write(user_config, arcname=os.path.basename(user_config))
     return f'{filepath}/wg.zip'
   
   
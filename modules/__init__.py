@@ -1,2 +1,4 @@
 from .wg import WireGuard
 from .squid import SquidManager
+from .reconciler import Reconciler
+from .idle import IdleScheduler
@@ -0,0 +1,315 @@
+from src.utils import setup_logger
+import calendar
+import asyncio
+import json
+import time
+import os
+
+logger = setup_logger('SQUID|LOG')
+
+STATE_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.squid', 'access_state.json')
+
+
+MONTHS = {m.encode(): i for i, m in enumerate(calendar.month_abbr) if m}
+
+
+class SquidLogParser:
+  """ Pulls fields by fixed position for a known squid `logformat`:
+    squid     `%ts.%03tu %6tr %>a %Ss/%03>Hs %<st %rm %ru %[un %Sh/%<a %mt`
+    common    `%>a %[ui %[un [%tl] "%rm %ru HTTP/%rv" %>Hs %<st %Ss:%Sh`
+    combined  common + `"%{Referer}>h" "%{User-Agent}>h"`
+  Works on raw bytes; lines that do not fit the layout are skipped. """
+  FORMATS = ('squid', 'common', 'combined')
+
+  def __init__(self, logformat: str = None) -> None:
+    self.logformat = logformat or os.getenv('SQUID_LOGFORMAT', 'squid')
+    if self.logformat not in self.FORMATS:
+      raise ValueError(f'Unsupported squid logformat: {self.logformat}')
+    self.native = self.logformat == 'squid'
+    self._clf_cache = (None, 0.0)
+
+  def _clf_time(self, stamp: bytes, zone: bytes) -> float:
+    """ `[21/Oct/2025:10:00:00` `+0300]` -> epoch; consecutive lines mostly share the second """
+    key = stamp + zone
+    if key == self._clf_cache[0]: return self._clf_cache[1]
+    day, month, rest = stamp[1:].split(b'/', 2)
+    year, hh, mm, ss = rest.split(b':')
+    ts = calendar.timegm((int(year), MONTHS[month], int(day), int(hh), int(mm), int(ss)))
+    sign = -1 if zone[:1] == b'-' else 1
+    ts -= sign * (int(zone[1:3]) * 3600 + int(zone[3:5]) * 60)
+    self._clf_cache = (key, float(ts))
+    return self._clf_cache[1]
+
+  def __call__(self, line: bytes) -> tuple[str, float] | None:
+    try:
+      if self.native:
+        parts = line.split(None, 8)
+        user = parts[7]
+        if user == b'-': return None
+        return user.decode(errors='replace'), float(parts[0])
+      parts = line.split(None, 5)
+      user = parts[2]
+      if user == b'-': return None
+      return user.decode(errors='replace'), self._clf_time(parts[3], parts[4])
+    except (IndexError, ValueError, KeyError):
+      return None
+
+  @staticmethod
+  def _host(method: bytes, url: bytes) -> str:
+    if method != b'CONNECT':
+      start = url.find(b'//')
+      url = url[start + 2:] if start >= 0 else url
+      url = url.split(b'/', 1)[0]
+    return url.rsplit(b':', 1)[0].decode(errors='replace') if url[-1:].isdigit() else url.decode(errors='replace')
+
+  def record(self, line: bytes) -> tuple[str, float, int, int, str] | None:
+    """ (user, epoch, bytes, http status, destination host) of a line """
+    try:
+      if self.native:
+        parts = line.split(None, 9)
+        user = parts[7]
+        if user == b'-': return None
+        status = int(parts[3].rsplit(b'/', 1)[1])
+        return user.decode(errors='replace'), float(parts[0]), int(parts[4]), status, self._host(parts[5], parts[6])
+      parts = line.split(None, 10)
+      user = parts[2]
+      if user == b'-': return None
+      return user.decode(errors='replace'), self._clf_time(parts[3], parts[4]), int(parts[9]), int(parts[8]), self._host(parts[5][1:], parts[6])
+    except (IndexError, ValueError, KeyError):
+      return None
+
+
+class LastSeenIndex:
+  """ username -> last activity (epoch seconds) """
+  name = 'last_seen'
+
+  def __init__(self, parse) -> None:
+    self.parse = parse
+    self.users: dict[str, float] = {}
+
+  def feed(self, lines: list[bytes]) -> None:
+    users = self.users
+    for raw in lines:
+      parsed = self.parse(raw)
+      if parsed is None: continue
+      uname, ts = parsed
+      if ts > users.get(uname, 0): users[uname] = ts
+
+  def state(self) -> dict:
+    return self.users
+
+  def load(self, state: dict) -> None:
+    self.users = {k: float(v) for k, v in (state or {}).items()}
+
+
+class TrafficIndex:
+  """ Per-user bytes, requests, errors (status >= 400) and top destination hosts in hourly buckets.
+  Hosts are counted with Space-Saving (at most `top` per user and hour, the least counted is
+  replaced), and buckets older than `hours` are dropped, so memory is bounded by users x hours. """
+  name = 'traffic'
+
+  def __init__(self, parse, hours: int = None, top: int = None) -> None:
+    self.parse = parse
+    self.hours = hours or int(os.getenv('PROXY_STATS_HOURS', 168))
+    self.top = top or int(os.getenv('PROXY_STATS_TOP_HOSTS', 10))
+    # hour -> user -> [bytes, requests, errors, {host: requests}]
+    self.buckets: dict[int, dict[str, list]] = {}
+
+  def _count_host(self, hosts: dict, host: str) -> None:
+    if host in hosts:
+      hosts[host] += 1
+    elif len(hosts) < self.top:
+      hosts[host] = 1
+    else:
+      victim = min(hosts, key=hosts.get)
+      hosts[host] = hosts.pop(victim) + 1
+
+  def feed(self, lines: list[bytes]) -> None:
+    buckets, parse = self.buckets, self.parse
+    hour, bucket = None, None
+    for raw in lines:
+      parsed = parse(raw)
+      if parsed is None: continue
+      user, ts, size, status, host = parsed
+      if int(ts // 3600) != hour:
+        hour = int(ts // 3600)
+        bucket = buckets.get(hour)
+        if bucket is None: bucket = buckets[hour] = {}
+      counters = bucket.get(user)
+      if counters is None: counters = bucket[user] = [0, 0, 0, {}]
+      counters[0] += size
+      counters[1] += 1
+      if status >= 400: counters[2] += 1
+      self._count_host(counters[3], host)
+    if buckets:
+      oldest = max(buckets) - self.hours
+      for stale in [h for h in buckets if h <= oldest]: del buckets[stale]
+
+  def query(self, user: str = None, hours: int = 24, now: float = None) -> dict:
+    """ Totals per user over the last `hours`; with `user`, also the hourly series """
+    first = int((now or time.time()) // 3600) - hours + 1
+    totals: dict[str, list] = {}
+    series = []
+    for hour in sorted(h for h in self.buckets if h >= first):
+      for name, (size, requests, errors, hosts) in self.buckets[hour].items():
+        if user is not None and name != user: continue
+        total = totals.get(name)
+        if total is None: total = totals[name] = [0, 0, 0, {}]
+        total[0] += size; total[1] += requests; total[2] += errors
+        for host, count in hosts.items(): total[3][host] = total[3].get(host, 0) + count
+        if user is not None: series.append(dict(hour=hour * 3600, bytes=size, requests=requests, errors=errors))
+    body = {
+      name: dict(bytes=size, requests=requests, errors=errors, top_hosts=sorted(hosts.items(), key=lambda h: -h[1])[:self.top])
+      for name, (size, requests, errors, hosts) in totals.items()
+    }
+    if user is not None: return dict(user=user, hours=hours, **body.get(user, dict(bytes=0, requests=0, errors=0, top_hosts=[])), series=series)
+    return dict(hours=hours, users=body)
+
+  def state(self) -> dict:
+    return {str(hour): bucket for hour, bucket in self.buckets.items()}
+
+  def load(self, state: dict) -> None:
+    self.buckets = {int(hour): bucket for hour, bucket in (state or {}).items()}
+
+
+class AccessLogFollower:
+  """ Tails access.log from a saved byte offset and feeds complete lines to consumers.
+  Rotation is detected by inode (rename + reopen) and by size (copytruncate);
+  the rest of a renamed file is drained before switching to the new one.
+  Offset, inode and consumer state are persisted together in one state file,
+  by the started follower only; others (non-leader workers) catch up on reads without saving. """
+  CHUNK = 1 << 20
+
+  def __init__(self, path, consumers: list, state_file: str = None, interval: float = None) -> None:
+    self.path = str(path)
+    self.consumers = consumers
+    self.state_file = state_file or os.getenv('SQUID_STATE_FILE', STATE_FILE)
+    self.interval = interval or float(os.getenv('SQUID_LOG_POLL', 2))
+    self.save_every = float(os.getenv('SQUID_STATE_SAVE', 30))
+    self._saved = 0.0
+    self.inode: int | None = None
+    self.offset = 0
+    self._fh = None
+    self._dirty = False
+    self._skip = False
+    self._lock = asyncio.Lock()
+    self._task: asyncio.Task | None = None
+    self._load()
+
+  def _load(self) -> None:
+    try:
+      with open(self.state_file, 'r') as f:
+        state = json.load(f)
+    except (FileNotFoundError, ValueError):
+      return
+    self.inode, self.offset = state.get('inode'), state.get('offset', 0)
+    for consumer in self.consumers:
+      consumer.load(state.get(consumer.name))
+
+  def _save(self) -> None:
+    os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+    state = dict(inode=self.inode, offset=self.offset)
+    for consumer in self.consumers:
+      state[consumer.name] = consumer.state()
+    tmp = f'{self.state_file}.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(state, f)
+    os.replace(tmp, self.state_file)
+    self._saved = time.monotonic()
+    self._dirty = False
+
+  def _open(self) -> bool:
+    try:
+      fh = open(self.path, 'rb')
+    except FileNotFoundError:
+      return False
+    inode = os.fstat(fh.fileno()).st_ino
+    if inode != self.inode:
+      self.inode, self.offset = inode, 0
+    fh.seek(self.offset)
+    self._fh = fh
+    return True
+
+  def _drain(self) -> int:
+    """ Reads complete lines from the current position, returns the number of lines fed """
+    fed = 0
+    while True:
+      self._fh.seek(self.offset)
+      data = self._fh.read(self.CHUNK)
+      if not data: return fed
+      end = data.rfind(b'\n')
+      if end < 0:
+        if len(data) < self.CHUNK: return fed
+        # a line longer than CHUNK is no access.log line, it is skipped up to its newline
+        self.offset += len(data)
+        self._skip = True
+        continue
+      start = 0
+      if self._skip:
+        start = data.find(b'\n') + 1
+        self._skip = False
+      if start <= end:
+        lines = data[start:end].split(b'\n')
+        for consumer in self.consumers:
+          consumer.feed(lines)
+        fed += len(lines)
+      self.offset += end + 1
+
+  def _poll(self) -> int:
+    if self._fh is None and not self._open(): return 0
+    fed = self._drain()
+    try:
+      st = os.stat(self.path)
+    except FileNotFoundError:
+      return fed
+    if st.st_ino != self.inode:
+      logger.info(f'{self.path} rotated, following new file')
+      # squid may have written to the renamed file after the drain above
+      fed += self._drain()
+      self._fh.close()
+      self._fh = None
+      if self._open(): fed += self._drain()
+    elif st.st_size < self.offset:
+      logger.info(f'{self.path} truncated, restarting from the beginning')
+      self.offset = 0
+      fed += self._drain()
+    # offset and consumer state are saved together, at most every `save_every` seconds
+    self._dirty = self._dirty or bool(fed)
+    if self._dirty and self._task is not None and time.monotonic() - self._saved >= self.save_every: self._save()
+    return fed
+
+  async def poll(self) -> int:
+    """ Catches up with the log; concurrent callers wait for the same pass """
+    async with self._lock:
+      return await asyncio.get_running_loop().run_in_executor(None, self._poll)
+
+  async def read(self, fn, *args):
+    """ Catches up, then calls `fn` while no pass can touch the consumers """
+    async with self._lock:
+      await asyncio.get_running_loop().run_in_executor(None, self._poll)
+      return fn(*args)
+
+  async def _run(self) -> None:
+    while True:
+      try:
+        await self.poll()
+      except asyncio.CancelledError:
+        raise
+      except Exception as ex:
+        logger.error(f'Following {self.path} failed: {ex}')
+      await asyncio.sleep(self.interval)
+
+  async def start(self, app=None) -> None:
+    if self._task is None:
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self, app=None) -> None:
+    if self._task is None: return
+    self._task.cancel()
+    try: await self._task
+    except asyncio.CancelledError: pass
+    self._task = None
+    if self._dirty: self._save()
+    if self._fh is not None:
+      self._fh.close()
+      self._fh = None
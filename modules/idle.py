@@ -0,0 +1,179 @@
+from src.utils import setup_logger, STATS
+from .wg import DEACTIVATED, SUSPENDED
+from pathlib import Path
+import asyncio
+import heapq
+import json
+import time
+import os
+
+logger = setup_logger('WG|IDLE')
+STATE_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.wg.idle.json')
+
+
+class IdleScheduler:
+  """ Suspends peers whose latest handshake is older than WG_IDLE_AFTER seconds.
+  Deadlines sit in a min-heap with one entry per peer; a popped entry whose peer handshaked
+  meanwhile is pushed back with its new deadline, so a tick costs O(k log n) for the k peers
+  that come due. Due peers are stored and set as SUSPENDED in one batch, their allowed-ips are
+  kept in the state file and restored as they were when a suspended peer handshakes again
+  (the client is trying to connect). A peer the API deactivated, before or during a suspension,
+  stores DEACTIVATED instead and is never suspended or woken by the scheduler.
+  The state file belongs to the started scheduler (the leader process); elsewhere wakes are not saved. """
+  def __init__(self, wg, idle_after: float = None, interval: float = None, state_file: str = None, stats=None) -> None:
+    self.wg = wg
+    self.idle_after = idle_after if idle_after is not None else float(os.getenv('WG_IDLE_AFTER', 0))
+    self.interval = interval or float(os.getenv('WG_IDLE_INTERVAL', 60))
+    self.state_file = Path(state_file or os.getenv('WG_IDLE_STATE', STATE_FILE))
+    self.heap: list[tuple[float, str]] = []
+    self.deadlines: dict[str, float] = {}
+    self.handshakes: dict[str, int] = {}
+    # puid -> dict(handshake=latest handshake when suspended, allowed_ips=to restore)
+    self.suspended: dict[str, dict] = self._load()
+    self.stats = stats
+    self.owner = False
+    self._cursor = 0
+    self._lock = asyncio.Lock()
+    self._task: asyncio.Task | None = None
+
+  def _load(self) -> dict[str, dict]:
+    try:
+      state = json.loads(self.state_file.read_text())
+      # older state files kept only the handshake
+      return {puid: v if isinstance(v, dict) else dict(handshake=v, allowed_ips=None) for puid, v in state.items()}
+    except FileNotFoundError:
+      return {}
+    except ValueError as ex:
+      logger.error(f'Ignoring corrupt {self.state_file}: {ex}')
+      return {}
+
+  def _save(self) -> None:
+    if not self.owner: return
+    tmp = self.state_file.with_name(f'.{self.state_file.name}.tmp')
+    tmp.write_text(json.dumps(self.suspended))
+    os.replace(tmp, self.state_file)
+
+  def _arm(self, puid: str, since: float) -> None:
+    tracked = puid in self.deadlines
+    self.deadlines[puid] = since + self.idle_after
+    if not tracked: heapq.heappush(self.heap, (self.deadlines[puid], puid))
+
+  def observe(self, peers: dict[str, dict], now: float) -> list[str]:
+    """ Feeds changed peers from the sampler, returns suspended peers that handshaked since """
+    wake = []
+    for puid, stat in peers.items():
+      handshake = stat.get('latest_handshake') or 0
+      if puid in self.suspended:
+        if handshake > self.suspended[puid]['handshake']: wake.append(puid)
+        continue
+      if puid in self.deadlines and handshake == self.handshakes.get(puid): continue
+      self.handshakes[puid] = handshake
+      self._arm(puid, handshake or now)
+    return wake
+
+  def due(self, now: float) -> list[str]:
+    due = []
+    while self.heap and self.heap[0][0] <= now:
+      _, puid = heapq.heappop(self.heap)
+      deadline = self.deadlines.get(puid)
+      if deadline is None: continue
+      if deadline > now:
+        heapq.heappush(self.heap, (deadline, puid))
+        continue
+      del self.deadlines[puid]
+      due.append(puid)
+    return due
+
+  def _restorable(self, puids: list[str]) -> dict[str, str]:
+    """ Stored allowed-ips of the peers that can be suspended: not deactivated, not unknown """
+    restore = {}
+    for puid in puids:
+      record = self.wg.store.get(puid)
+      allowed_ips = record and record.get('allowed_ips')
+      if allowed_ips and allowed_ips not in (DEACTIVATED, SUSPENDED): restore[puid] = allowed_ips
+    return restore
+
+  def _ours(self, puids: list[str]) -> list[str]:
+    """ Suspended peers the store still records as SUSPENDED; the others were deactivated,
+    reactivated, edited or removed through the API since and are forgotten """
+    records = {puid: self.wg.store.get(puid) for puid in puids if puid in self.suspended}
+    return [puid for puid, record in records.items() if record and record.get('allowed_ips') == SUSPENDED]
+
+  async def suspend(self, puids: list[str]) -> list[dict]:
+    restore = await self.wg._io(self._restorable, puids)
+    now = time.time()
+    for puid in puids:
+      # deactivated through the API (or without allowed-ips to restore): checked again next period
+      if puid not in restore: self._arm(puid, now)
+    if not restore: return []
+    results = await self.wg.apply_batch([dict(action='deactivate', uuid=puid, suspend=True) for puid in restore])
+    for result in results:
+      puid = result['uuid']
+      if result['ok']: self.suspended[puid] = dict(handshake=self.handshakes.pop(puid, 0), allowed_ips=restore[puid])
+      else: logger.error(f"Suspending {puid} failed: {result.get('message')}")
+    await self.wg._io(self._save)
+    logger.info(f"Suspended {sum(r['ok'] for r in results)} idle peers")
+    return results
+
+  async def wake(self, puids: list[str]) -> list[dict]:
+    """ Restores suspended peers' allowed-ips and gives them a fresh idle period;
+    peers the scheduler did not suspend are left as they are """
+    async with self._lock:
+      ours = await self.wg._io(self._ours, puids)
+      for puid in puids:
+        if puid in self.suspended and puid not in ours: self.suspended.pop(puid)
+      results = await self.wg.apply_batch([
+        dict(action='reactivate', uuid=puid, allowed_ips=self.suspended[puid]['allowed_ips']) for puid in ours
+      ])
+      results += [dict(uuid=puid, action='reactivate', ok=False, message='Not suspended for idleness') for puid in puids if puid not in ours]
+      now = time.time()
+      for result in results:
+        if not result['ok']: continue
+        self.suspended.pop(result['uuid'], None)
+        self.handshakes.pop(result['uuid'], None)
+        if self.idle_after > 0: self._arm(result['uuid'], now)
+      await self.wg._io(self._save)
+      return results
+
+  async def tick(self) -> None:
+    now = time.time()
+    changed = self.stats.since(self._cursor)
+    self._cursor = self.stats.cursor
+    wake = self.observe(changed, now)
+    if wake: await self.wake(wake)
+    async with self._lock:
+      due = [puid for puid in self.due(now) if puid in self.stats.snapshot]
+      if due: await self.suspend(due)
+
+  @property
+  def status(self) -> dict:
+    return dict(
+      idle_after=self.idle_after, tracked=len(self.deadlines), suspended=sorted(self.suspended),
+      next_deadline=self.heap[0][0] if self.heap else None,
+    )
+
+  async def _run(self) -> None:
+    while True:
+      await asyncio.sleep(self.interval)
+      try:
+        await self.tick()
+      except asyncio.CancelledError:
+        raise
+      except Exception as ex:
+        logger.error(f'Idle check failed: {ex}')
+
+  async def start(self, app=None) -> None:
+    self.stats = app[STATS]
+    if not self.owner:
+      self.owner = True
+      self.suspended = self._load()
+    if self._task is None and self.idle_after > 0:
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self, app=None) -> None:
+    self.owner = False
+    if self._task is None: return
+    self._task.cancel()
+    try: await self._task
+    except asyncio.CancelledError: pass
+    self._task = None
@@ -0,0 +1,160 @@
+from ipaddress import IPv4Address, IPv4Network
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import tempfile
+import fcntl
+import re
+import os
+
+_FREE_BYTE = re.compile(rb'[^\xff]')
+
+
+class AddressPool:
+  """ Bitmap of used addresses in the WireGuard subnet, one bit per address.
+  Allocation resumes from a rolling cursor and skips full bytes with a C-level search,
+  so next-free is O(1) amortized. Network, broadcast and server addresses are reserved.
+  A `shared` pool is used by several worker processes: every change holds an flock on
+  `<path>.lock`, reloads the file if another process wrote it and writes it back before unlocking. """
+  def __init__(self, subnet: str, path: Path, server_ip: str = None, shared: bool = False) -> None:
+    self.network = IPv4Network(subnet, strict=False)
+    self.path = Path(path)
+    self.shared = shared
+    self._stamp = None
+    self.base = int(self.network.network_address)
+    self.size = self.network.num_addresses
+    self.bitmap = bytearray((self.size + 7) // 8)
+    self.reserved = {0, self.size - 1} if self.size > 2 else set()
+    self.reserved.add(self._index(server_ip or str(self.network.network_address + 1)))
+    self._cursor = 0
+    self._dirty = False
+    self._lock = threading.Lock()
+    self._load()
+
+  def _index(self, ip: str) -> int | None:
+    idx = int(IPv4Address(ip.split('/')[0])) - self.base
+    return idx if 0 <= idx < self.size else None
+
+  def _mark(self) -> None:
+    for idx in self.reserved:
+      if idx is not None: self.bitmap[idx >> 3] |= 1 << (idx & 7)
+    # bits past the end of a partial last byte are never allocatable
+    for idx in range(self.size, len(self.bitmap) * 8):
+      self.bitmap[idx >> 3] |= 1 << (idx & 7)
+
+  def _file_stamp(self) -> tuple | None:
+    try:
+      st = os.stat(self.path)
+    except FileNotFoundError:
+      return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+  def _load(self) -> None:
+    self._stamp = self._file_stamp()
+    try:
+      data = self.path.read_bytes()
+    except FileNotFoundError:
+      data = b''
+    if len(data) == len(self.bitmap): self.bitmap[:] = data
+    self._mark()
+
+  def _write(self, data: bytes) -> None:
+    """ Called with `_lock` held; the temp file is unique all the same, a crashed writer may leave one """
+    fd, tmp = tempfile.mkstemp(prefix=f'.{self.path.name}.', suffix='.tmp', dir=self.path.parent)
+    try:
+      with os.fdopen(fd, 'wb') as f: f.write(data)
+      os.replace(tmp, self.path)
+    except BaseException:
+      Path(tmp).unlink(missing_ok=True)
+      raise
+    self._stamp = self._file_stamp()
+
+  @contextmanager
+  def _locked(self):
+    with self._lock:
+      if not self.shared:
+        yield
+        return
+      with open(self.path.with_name(f'{self.path.name}.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if self._file_stamp() != self._stamp: self._load()
+        yield
+        if self._dirty:
+          self._write(bytes(self.bitmap))
+          self._dirty = False
+
+  def save(self) -> None:
+    if self.shared: return
+    with self._lock:
+      if not self._dirty: return
+      self._write(bytes(self.bitmap))
+      self._dirty = False
+
+  def snapshot(self) -> bytes:
+    """ Current bitmap, as a base for `rebuild(..., since=)` """
+    with self._locked():
+      return bytes(self.bitmap)
+
+  def __contains__(self, ip: str) -> bool:
+    idx = self._index(ip)
+    if idx is None: return False
+    with self._locked():
+      return bool(self.bitmap[idx >> 3] & (1 << (idx & 7)))
+
+  def claim(self, ip: str) -> bool:
+    """ Reserves `ip` unless it is taken already, in one step; addresses outside the subnet are not tracked """
+    idx = self._index(ip)
+    if idx is None: return True
+    with self._locked():
+      if self.bitmap[idx >> 3] & (1 << (idx & 7)): return False
+      self.bitmap[idx >> 3] |= 1 << (idx & 7)
+      self._dirty = True
+    return True
+
+  def allocate(self) -> str:
+    with self._locked():
+      for start in (self._cursor >> 3, 0):
+        m = _FREE_BYTE.search(self.bitmap, start)
+        if m is None: continue
+        pos = m.start()
+        byte = self.bitmap[pos]
+        bit = (~byte & (byte + 1)).bit_length() - 1
+        idx = (pos << 3) | bit
+        self.bitmap[pos] |= 1 << bit
+        self._cursor = idx + 1
+        self._dirty = True
+        return str(IPv4Address(self.base + idx))
+    raise RuntimeError(f'Address pool {self.network} is exhausted')
+
+  def reserve(self, ip: str) -> bool:
+    idx = self._index(ip)
+    if idx is None: return False
+    with self._locked():
+      self.bitmap[idx >> 3] |= 1 << (idx & 7)
+      self._dirty = True
+    return True
+
+  def release(self, ip: str) -> None:
+    idx = self._index(ip)
+    if idx is None or idx in self.reserved: return
+    with self._locked():
+      self.bitmap[idx >> 3] &= ~(1 << (idx & 7)) & 0xff
+      self._cursor = min(self._cursor, idx)
+      self._dirty = True
+
+  def rebuild(self, addresses, since: bytes = None) -> None:
+    """ Resets the bitmap to exactly the given addresses (plus reserved ones).
+    With `since` (an earlier snapshot), addresses taken after it are kept as well:
+    other workers keep allocating while the addresses are collected. """
+    with self._locked():
+      taken = int.from_bytes(self.bitmap, 'little') & ~int.from_bytes(since, 'little') if since is not None else 0
+      self.bitmap[:] = bytes(len(self.bitmap))
+      self._mark()
+      for ip in addresses:
+        idx = self._index(ip)
+        if idx is not None: self.bitmap[idx >> 3] |= 1 << (idx & 7)
+      if taken:
+        merged = int.from_bytes(self.bitmap, 'little') | taken
+        self.bitmap[:] = merged.to_bytes(len(self.bitmap), 'little')
+      self._cursor = 0
+      self._dirty = True
@@ -0,0 +1,60 @@
+from collections import deque
+from typing import Callable
+import threading
+import time
+import os
+
+
+class KeyPool:
+  """ Keeps pre-generated keypairs ready so peer creation skips Curve25519 key generation.
+  A worker thread refills up to `size` once the depth drops below `low_water`,
+  generating at most `rate` pairs per second (0 = as fast as possible). """
+  def __init__(self, generate: Callable, size: int = None, low_water: int = None, rate: float = None) -> None:
+    self.generate = generate
+    self.size = size if size is not None else int(os.getenv('WG_KEYPOOL_SIZE', 128))
+    self.low_water = low_water if low_water is not None else int(os.getenv('WG_KEYPOOL_LOW', max(1, self.size // 4)))
+    self.rate = rate if rate is not None else float(os.getenv('WG_KEYPOOL_RATE', 0))
+    self.hits = 0
+    self.misses = 0
+    self._pairs: deque = deque()
+    self._wake = threading.Event()
+    self._stopped = threading.Event()
+    self._thread: threading.Thread | None = None
+
+  def start(self) -> None:
+    if self._thread is not None or self.size <= 0: return
+    self._stopped.clear()
+    self._thread = threading.Thread(target=self._run, name='wg-keypool', daemon=True)
+    self._thread.start()
+    self._wake.set()
+
+  def stop(self) -> None:
+    self._stopped.set()
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _run(self) -> None:
+    while not self._stopped.is_set():
+      self._wake.wait()
+      self._wake.clear()
+      while len(self._pairs) < self.size and not self._stopped.is_set():
+        self._pairs.append(self.generate())
+        if self.rate: time.sleep(1 / self.rate)
+
+  def take(self) -> tuple | None:
+    """ A ready keypair, or None when the pool is empty (the caller generates one itself) """
+    self.start()
+    try:
+      pair = self._pairs.popleft()
+      self.hits += 1
+    except IndexError:
+      pair = None
+      self.misses += 1
+    if len(self._pairs) < self.low_water: self._wake.set()
+    return pair
+
+  @property
+  def stats(self) -> dict:
+    return dict(depth=len(self._pairs), size=self.size, low_water=self.low_water, hits=self.hits, misses=self.misses)
@@ -0,0 +1,133 @@
+from src.utils import setup_logger, STATS
+from .wg import DEACTIVATED, SUSPENDED
+from ipaddress import ip_network
+import asyncio
+import os
+
+logger = setup_logger('WG|RECONCILE')
+
+
+class Reconciler:
+  """ Brings the live interface in line with the peer store.
+  Desired state is every stored peer with its recorded allowed-ips; the live state
+  is the dump Stats parses. Only the difference is applied, in one batched `wg set`.
+  Live peers unknown to the store are reported and removed only with WG_RECONCILE_PRUNE;
+  stored peers without recorded allowed-ips are reported as `unknown` and left alone.
+  The kernel routes a prefix to one peer only, so a prefix several stored peers claim (the
+  shared /24 of non-isolated peers) is reported under `conflicts` and left with its live holder. """
+  def __init__(self, wg, interval: float = None, prune: bool = None, stats=None) -> None:
+    self.wg = wg
+    self.interval = interval if interval is not None else float(os.getenv('WG_RECONCILE_INTERVAL', 300))
+    self.prune = prune if prune is not None else os.getenv('WG_RECONCILE_PRUNE', '0') in ('1', 'true', 'yes')
+    self.stats = stats
+    self._lock = asyncio.Lock()
+    self._task: asyncio.Task | None = None
+
+  @staticmethod
+  def _normalize(allowed_ips: str | None) -> str:
+    """ Sorted canonical networks (`10.8.0.2/24` is `10.8.0.0/24` to the kernel);
+    `(none)` and the deactivation markers all mean no allowed-ips """
+    if not allowed_ips or allowed_ips == '(none)': return ''
+    networks = set()
+    for ip in allowed_ips.split(','):
+      ip = ip.strip()
+      if not ip: continue
+      try:
+        ip = str(ip_network(ip, strict=False))
+      except ValueError:
+        pass
+      if ip not in (DEACTIVATED, SUSPENDED): networks.add(ip)
+    return ','.join(sorted(networks))
+
+  @classmethod
+  def _desired_ips(cls, record: dict) -> str | None:
+    """ None when the record has no allowed-ips to go by (peers migrated from the file layout) """
+    if not record.get('allowed_ips'): return None
+    return cls._normalize(record['allowed_ips'])
+
+  async def _current(self, change: dict) -> bool:
+    record = await self.wg._io(self.wg.store.get, change['uuid'])
+    desired = change.get('desired', change['allowed_ips'])
+    return bool(record) and record['pubkey'] == change['pubkey'] and self._desired_ips(record) == desired
+
+  @staticmethod
+  def _networks(allowed_ips: str) -> set[str]:
+    return set(allowed_ips.split(',')) - {''}
+
+  @classmethod
+  def _shared(cls, desired) -> set[str]:
+    """ Networks claimed by more than one of the `desired` allowed-ips """
+    seen, shared = set(), set()
+    for allowed_ips in desired:
+      for network in cls._networks(allowed_ips):
+        (shared if network in seen else seen).add(network)
+    return shared
+
+  async def diff(self) -> dict:
+    records = await self.wg._io(lambda: list(self.wg.store.items()))
+    live = {p['pubkey']: p for p in await self.stats._get_wg_stats()}
+    desired = {record['uuid']: self._desired_ips(record) for record in records}
+    shared = self._shared(ips for ips in desired.values() if ips)
+    add, update, unknown, conflicts = [], [], [], []
+    for record in records:
+      peer = live.pop(record['pubkey'], None)
+      allowed_ips = desired[record['uuid']]
+      if allowed_ips is None:
+        unknown.append(record['uuid'])
+        continue
+      current = self._normalize(peer.get('allowed_ips')) if peer is not None else ''
+      networks = self._networks(allowed_ips)
+      claimed = networks & shared
+      if claimed: conflicts.append(dict(uuid=record['uuid'], networks=sorted(claimed)))
+      # a shared prefix stays where it is live, the rest is what the store says
+      target = ','.join(sorted((networks - shared) | (self._networks(current) & claimed)))
+      entry = dict(uuid=record['uuid'], pubkey=record['pubkey'], allowed_ips=target)
+      if target != allowed_ips: entry['desired'] = allowed_ips
+      if peer is None:
+        add.append(entry)
+      elif current != target:
+        update.append(dict(entry, live=peer.get('allowed_ips')))
+    unmanaged = [dict(pubkey=pubkey, allowed_ips=p.get('allowed_ips')) for pubkey, p in live.items()]
+    return dict(add=add, update=update, unmanaged=unmanaged, unknown=unknown, conflicts=conflicts, prune=self.prune)
+
+  async def reconcile(self, dry_run: bool = False) -> dict:
+    async with self._lock:
+      diff = await self.diff()
+      if dry_run: return diff
+      changes = [*diff['add'], *diff['update']]
+      if self.prune: changes += diff['unmanaged']
+      if not changes: return diff
+      async with self.wg._locked(*(c.get('uuid') for c in changes)):
+        # a peer edited between the diff and taking its lock is left for the next pass
+        changes = [c for c in changes if 'uuid' not in c or await self._current(c)]
+        clauses = [
+          ['peer', c['pubkey'], 'allowed-ips', c['allowed_ips']] if 'uuid' in c else ['peer', c['pubkey'], 'remove']
+          for c in changes
+        ]
+        errors = await self.wg.apply_clauses(clauses)
+      failed = [dict(pubkey=c['pubkey'], message=e) for c, e in zip(changes, errors) if e]
+      logger.info(f'Reconciled {len(clauses) - len(failed)} peers, {len(failed)} failed')
+      return dict(diff, failed=failed)
+
+  async def _run(self) -> None:
+    while True:
+      try:
+        await self.reconcile()
+      except asyncio.CancelledError:
+        raise
+      except Exception as ex:
+        logger.error(f'Reconcile failed: {ex}')
+      if not self.interval: return
+      await asyncio.sleep(self.interval)
+
+  async def start(self, app=None) -> None:
+    self.stats = app[STATS]
+    if self._task is None:
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self, app=None) -> None:
+    if self._task is None: return
+    self._task.cancel()
+    try: await self._task
+    except asyncio.CancelledError: pass
+    self._task = None
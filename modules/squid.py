@@ -1,170 +1,291 @@
 import asyncio
-import aiofiles
+import fcntl
+import hashlib
+import os
 import pathlib
-import re
+import secrets
 import shlex
-import subprocess
-from datetime import datetime, timezone, timedelta
-from typing import Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Iterable, Tuple
+from src.utils import METRICS
+from .access_log import AccessLogFollower, LastSeenIndex, SquidLogParser, TrafficIndex
+
+try:
+    import bcrypt
+except ImportError:  # bcrypt опционален, по умолчанию APR1
+    bcrypt = None
+
+DEFAULT_PASSWD_FILE = os.getenv('SQUID_PASSWD_FILE', "/etc/squid/passwd")
+ACCESS_LOG = os.getenv('SQUID_ACCESS_LOG', "/var/log/squid/access.log")
+RELOAD_CMD = os.getenv('SQUID_RELOAD_CMD', 'sudo squid -k reconfigure')
+HASH_SCHEME = os.getenv('SQUID_HASH', 'apr1')
+
+_ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def _to64(value: int, n: int) -> str:
+    out = ''
+    for _ in range(n):
+        out += _ITOA64[value & 0x3f]
+        value >>= 6
+    return out
+
+
+def apr1(password: str, salt: str = None) -> str:
+    """
+    APR1-MD5 (формат `htpasswd -m`), понимается basic_ncsa_auth без внешних зависимостей.
+    """
+    pw, salt = password.encode(), (salt or ''.join(secrets.choice(_ITOA64) for _ in range(8))).encode()[:8]
+    magic = b'$apr1$'
+    final = hashlib.md5(pw + salt + pw).digest()
+    ctx = pw + magic + salt
+    for pl in range(len(pw), 0, -16):
+        ctx += final[:min(16, pl)]
+    i = len(pw)
+    while i:
+        ctx += b'\0' if i & 1 else pw[:1]
+        i >>= 1
+    final = hashlib.md5(ctx).digest()
+    for i in range(1000):
+        ctx = pw if i & 1 else final
+        if i % 3:
+            ctx += salt
+        if i % 7:
+            ctx += pw
+        ctx += final if i & 1 else pw
+        final = hashlib.md5(ctx).digest()
+    out = ''.join(
+        _to64((final[a] << 16) | (final[b] << 8) | final[c], 4)
+        for a, b, c in ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5))
+    ) + _to64(final[11], 2)
+    return f'$apr1${salt.decode()}${out}'
+
+
+def hash_password(password: str, scheme: str = HASH_SCHEME) -> str:
+    if scheme == 'bcrypt':
+        if bcrypt is None:
+            raise RuntimeError('SQUID_HASH=bcrypt requires the bcrypt package')
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    return apr1(password)
+
+
+def hash_passwords(passwords: List[str], scheme: str = HASH_SCHEME) -> List[str]:
+    return [hash_password(pw, scheme) for pw in passwords]
+
+
+class HtpasswdStore:
+    """
+    htpasswd-файл в памяти. Читается один раз (и заново только при смене mtime),
+    изменения применяются пачкой: одна запись во временный файл и rename под flock.
+    """
+    def __init__(self, path: pathlib.Path, workers: int = None):
+        self.path = pathlib.Path(path)
+        self.lock_path = pathlib.Path(os.getenv('SQUID_PASSWD_LOCK', f'{self.path}.lock'))
+        self.users: Dict[str, str] = {}
+        self._mtime = None
+        self._lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers or int(os.getenv('SQUID_HASH_WORKERS', 4)), thread_name_prefix='htpasswd')
+        self._processes: Optional[ProcessPoolExecutor] = None
+
+    def _load(self) -> None:
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self.users, self._mtime = {}, None
+            return
+        if mtime == self._mtime:
+            return
+        users = {}
+        with open(self.path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or ':' not in line:
+                    continue
+                name, hashed = line.split(':', 1)
+                users[name] = hashed
+        self.users, self._mtime = users, mtime
+
+    def _write(self, upserts: Dict[str, str], deletes: Iterable[str]) -> Tuple[List[str], List[str]]:
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # перечитываем под локом, чтобы не затереть чужие изменения
+            self._load()
+            users = dict(self.users)
+            deleted, missing = [], []
+            for name in deletes:
+                (deleted if users.pop(name, None) is not None else missing).append(name)
+            users.update(upserts)
+            tmp = self.path.with_name(f'.{self.path.name}.tmp')
+            with open(tmp, 'w') as f:
+                f.writelines(f'{name}:{hashed}\n' for name, hashed in users.items())
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                st = self.path.stat()
+                os.chmod(tmp, st.st_mode)
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except (FileNotFoundError, PermissionError):
+                pass
+            os.replace(tmp, self.path)
+            self.users, self._mtime = users, self.path.stat().st_mtime_ns
+        return deleted, missing
+
+    async def _io(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def names(self) -> List[str]:
+        await self._io(self._load)
+        return list(self.users)
+
+    async def hash(self, passwords: Dict[str, str]) -> Dict[str, str]:
+        hashed = await asyncio.gather(*(self._io(hash_password, pw) for pw in passwords.values()))
+        return dict(zip(passwords, hashed))
+
+    async def hash_stream(self, passwords: Dict[str, str], chunk: int = 64):
+        """
+        Хэширует большую пачку на пуле процессов, отдаёт {username: hash} по мере готовности кусков.
+        """
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=int(os.getenv('SQUID_HASH_PROCS', os.cpu_count() or 1)))
+        loop = asyncio.get_running_loop()
+        names = list(passwords)
+
+        async def run(part: List[str]) -> Dict[str, str]:
+            hashed = await loop.run_in_executor(self._processes, hash_passwords, [passwords[u] for u in part])
+            return dict(zip(part, hashed))
+
+        for done in asyncio.as_completed([run(names[i:i + chunk]) for i in range(0, len(names), chunk)]):
+            yield await done
+
+    async def commit(self, upserts: Dict[str, str] = None, deletes: Iterable[str] = ()) -> Tuple[List[str], List[str]]:
+        """
+        Применяет пачку изменений ({username: hash} и удаления) одной атомарной записью.
+        Возвращает (удалённые, не найденные).
+        """
+        async with self._lock:
+            with METRICS.command('htpasswd'):
+                return await self._io(self._write, upserts or {}, list(deletes))
 
-HTPASSWD_CMD = "/usr/bin/htpasswd"  # путь к htpasswd
-DEFAULT_PASSWD_FILE = "/etc/squid/passwd"
-ACCESS_LOG = "/var/log/squid/access.log"
 
 class SquidManager:
     def __init__(self, passwd_file: str = DEFAULT_PASSWD_FILE, access_log: str = ACCESS_LOG):
         self.passwd_file = pathlib.Path(passwd_file)
         self.access_log = pathlib.Path(access_log)
+        self.passwd = HtpasswdStore(self.passwd_file)
+        self.parser = SquidLogParser()
+        self.last_seen = LastSeenIndex(self.parser)
+        self.traffic = TrafficIndex(self.parser.record)
+        self.follower = AccessLogFollower(self.access_log, [self.last_seen, self.traffic])
 
-    # ---- Utilities (sync subprocess) ----
-    def _run_cmd(self, cmd: List[str]) -> subprocess.CompletedProcess:
-        """Sync wrapper. Keep fast and deterministic for htpasswd usage."""
-        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False, text=True)
+    @staticmethod
+    def valid_username(username) -> bool:
+        """
+        Непустая строка без ':' и '/', иначе строка htpasswd будет испорчена.
+        """
+        return isinstance(username, str) and bool(username) and ":" not in username and "/" not in username
 
-    async def add_user(self, username: str, password: str) -> Dict:
+    async def reload(self) -> None:
         """
-        Добавить пользователя в htpasswd. Возвращает dict {ok:bool, msg:str}.
-        Асинхронный API, но использует subprocess синхронно через loop.run_in_executor.
+        Один reconfigure squid на пачку изменений.
         """
-        if not username or ":" in username or "/" in username:
+        if not RELOAD_CMD:
+            return
+        with METRICS.command('squid reload'):
+            proc = await asyncio.create_subprocess_exec(*shlex.split(RELOAD_CMD), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            _, stderr = await proc.communicate()
+        if proc.returncode:
+            raise RuntimeError(stderr.decode(errors='replace').strip() or f'{RELOAD_CMD} failed')
+
+    async def add_users(self, passwords: Dict[str, str]) -> Tuple[bool, str]:
+        """
+        Добавить/обновить пачку пользователей {username: password} одной записью файла.
+        """
+        invalid = [u for u in passwords if not self.valid_username(u)]
+        if invalid:
+            return False, f"invalid username: {', '.join(invalid)}"
+        return await self.commit_users(await self.passwd.hash(passwords))
+
+    async def commit_users(self, hashed: Dict[str, str]) -> Tuple[bool, str]:
+        """
+        Записать уже захэшированных пользователей {username: hash} одной записью и одним reload.
+        """
+        try:
+            await self.passwd.commit(hashed)
+            await self.reload()
+        except Exception as e:
+            return False, str(e)
+        return True, "user added/updated"
+
+    async def delete_users(self, usernames: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Удалить пачку пользователей одной записью файла. Возвращает (удалённые, не найденные).
+        """
+        deleted, missing = await self.passwd.commit(deletes=usernames)
+        if deleted:
+            await self.reload()
+        return deleted, missing
+
+    async def add_user(self, username: str, password: str) -> Tuple[bool, str]:
+        """
+        Добавить пользователя в htpasswd. Возвращает (ok, msg).
+        """
+        if not self.valid_username(username):
             return False, "invalid username"
+        return await self.add_users({username: password})
 
-        cmd = ['sudo', HTPASSWD_CMD, "-b", str(self.passwd_file), username, password]
-        loop = asyncio.get_event_loop()
-        proc = await loop.run_in_executor(None, lambda: self._run_cmd(cmd))
-        if proc.returncode == 0 or "added" in proc.stdout.lower() or "updated" in proc.stdout.lower():
-            return True, "user added/updated"
-        # если файл не существовал, htpasswd -b создаст его с -c, но мы не используем -c here
-        if "No such file" in proc.stderr or "No such" in proc.stdout:
-            # пробуем создать файл с -c
-            cmd2 = ['sudo', HTPASSWD_CMD, "-b", "-c", str(self.passwd_file), username, password]
-            proc2 = await loop.run_in_executor(None, lambda: self._run_cmd(cmd2))
-            if proc2.returncode == 0:
-                return True, "user added and passwd file created"
-            return False, proc2.stderr or proc2.stdout
-        return False, proc.stderr or proc.stdout
-
-    async def delete_user(self, username: str) -> Dict:
+    async def delete_user(self, username: str) -> Tuple[bool, str]:
         """
         Удалить пользователя из htpasswd.
         """
-        cmd = ['sudo', HTPASSWD_CMD, "-D", str(self.passwd_file), username]
-        loop = asyncio.get_event_loop()
-        proc = await loop.run_in_executor(None, lambda: self._run_cmd(cmd))
-        if proc.returncode == 0:
-            return True, "deleted"
-        # htpasswd -D возвращает non-zero если не найден; проверим stderr
-        if "not found" in proc.stderr.lower() or "no such" in proc.stderr.lower():
+        try:
+            deleted, _ = await self.delete_users([username])
+        except Exception as e:
+            return False, str(e)
+        if not deleted:
             return False, "user not found"
-        return False, proc.stderr or proc.stdout
+        return True, "deleted"
 
     async def list_users(self) -> List[str]:
         """
         Вернуть список пользователей из htpasswd-файла.
         """
-        if not self.passwd_file.exists():
-            return []
-        async with aiofiles.open(self.passwd_file, mode='r') as f:
-            content = await f.read()
-        users = []
-        for line in content.splitlines():
-            if not line.strip(): 
-                continue
-            parts = line.split(':', 1)
-            if parts:
-                users.append(parts[0])
-        return users
+        return await self.passwd.names()
 
     # ---- Log parsing / inactivity ----
-    async def _tail_access_log(self, max_lines: int = 20000) -> List[str]:
-        """
-        Читает последние max_lines из access.log асинхронно.
-        Для больших логов разумно ставить ограничения.
-        """
-        if not self.access_log.exists():
-            return []
-        stat = await asyncio.get_event_loop().run_in_executor(None, self.access_log.stat)
-        size = stat.st_size
-        # читаем файл полностью если небольшой, иначе читаем с конца
-        if size < 5 * 1024 * 1024:  # 5MB
-            async with aiofiles.open(self.access_log, mode='r') as f:
-                txt = await f.read()
-            return txt.splitlines()[-max_lines:]
-        # если большой, читает блок с конца
-        block = 200000  # bytes
-        async with aiofiles.open(self.access_log, mode='rb') as f:
-            await f.seek(max(0, size - block))
-            data = await f.read()
-        lines = data.decode(errors='ignore').splitlines()
-        return lines[-max_lines:]
+    async def start(self, app=None) -> None:
+        await self.follower.start()
+
+    async def stop(self, app=None) -> None:
+        await self.follower.stop()
 
     async def get_last_activity_by_user(self) -> Dict[str, datetime]:
         """
-        Парсит access.log и возвращает словарь {username: last_datetime_utc}.
-        Важно: формат логов может отличаться. Скрипт пытается извлечь имя пользователя (username).
-        """
-        lines = await self._tail_access_log()
-        user_last = {}
-        # Простая регулярка, надеемся что лог содержит имя пользователя в отдельном поле.
-        # Пример строки squid (типичный): "1596499200.123    200 192.0.2.1 TCP_MISS/200 1234 GET http://... user - HIER_NONE/0.0.0.0 text/html"
-        # Мы попытаемся найти username как поле, не являющееся IP или "-", и не URL.
-        user_pattern = re.compile(r'\s([A-Za-z0-9_\-\.]{1,64})\s')  # грубая попытка
-        # Также попробуем найти поле %un если присутствует: оно обычно стоит после URL, поэтому возьмём 7-е поле
-        for raw in reversed(lines):  # идём с конца, чтобы фиксировать последний таймстемп
-            parts = raw.split()
-            if len(parts) < 6:
-                # попробовать regex
-                m = user_pattern.search(raw)
-                if m:
-                    uname = m.group(1)
-                else:
-                    continue
-            else:
-                # попытка: username часто в поле 7 или 8
-                possible = None
-                for idx in (6,7,8):
-                    if idx < len(parts):
-                        cand = parts[idx]
-                        if cand != '-' and not cand.startswith('http') and not re.match(r'^\d+\.\d+\.\d+\.\d+$', cand):
-                            possible = cand
-                            break
-                uname = possible or None
-            if not uname:
-                continue
-            # поиском timestamp в начале строки (Unix epoch with fraction) или в формате [dd/Mon/...]
-            ts = None
-            m_ts = re.match(r'^(\d+\.\d+)', raw)
-            if m_ts:
-                try:
-                    ts = datetime.fromtimestamp(float(m_ts.group(1)), tz=timezone.utc)
-                except Exception:
-                    ts = None
-            if not ts:
-                # попробовать искать дату в формате [21/Oct/2025:...] - часто для httpd; пропустим если нет
-                m2 = re.search(r'\[(\d{1,2}/[A-Za-z]{3}/\d{4}:[^\]]+)\]', raw)
-                if m2:
-                    try:
-                        ts = datetime.strptime(m2.group(1), "%d/%b/%Y:%H:%M:%S %z")
-                        ts = ts.astimezone(timezone.utc)
-                    except Exception:
-                        ts = None
-            if not ts:
-                # fallback: текущее время (не идеально)
-                ts = datetime.now(timezone.utc)
-            # сохраняем последний (так как идём с конца, первое появление — последний)
-            if uname not in user_last:
-                user_last[uname] = ts
-        return user_last
-
-    async def purge_inactive(self, inactive_days: int = 30) -> Dict[str, List[str]]:
+        Возвращает словарь {username: last_datetime_utc} из индекса последней активности.
+        Перед ответом догоняет access.log с сохранённого смещения, поэтому результат
+        не зависит от размера лога.
+        """
+        return await self.follower.read(
+            lambda: {u: datetime.fromtimestamp(ts, tz=timezone.utc) for u, ts in self.last_seen.users.items()}
+        )
+
+    async def traffic_stats(self, user: Optional[str] = None, hours: int = 24) -> dict:
+        """
+        Трафик, запросы, ошибки и топ хостов по пользователям за последние hours часов
+        (с user — ещё и почасовой ряд). Тоже догоняет access.log перед ответом.
+        """
+        return await self.follower.read(self.traffic.query, user, hours)
+
+    async def purge_inactive(self, inactive_days: int = 30) -> Tuple[bool, Dict[str, List[str]]]:
         """
         Удаляет пользователей, которые не заходили более inactive_days.
-        Возвращает {"deleted":[...], "skipped":[...], "errors":[...]}
+        Возвращает (True, {"deleted":[...], "skipped":[...], "errors":[...]})
         """
         now = datetime.now(timezone.utc)
         last = await self.get_last_activity_by_user()
         users = await self.list_users()
-        deleted = []
+        stale = []
         skipped = []
         errors = []
         for u in users:
@@ -174,11 +295,15 @@ class SquidManager:
                 last_seen = datetime.fromtimestamp(0, tz=timezone.utc)
             age = (now - last_seen).days
             if age >= inactive_days:
-                success, message = await self.delete_user(u)
-                if success:
-                    deleted.append(u)
-                else:
-                    errors.append(f"{u}: {message}")
+                stale.append(u)
             else:
                 skipped.append(u)
+        # одна запись файла и один reload на всех устаревших пользователей
+        deleted = []
+        if stale:
+            try:
+                deleted, missing = await self.delete_users(stale)
+                errors.extend(f"{u}: user not found" for u in missing)
+            except Exception as e:
+                errors.extend(f"{u}: {e}" for u in stale)
         return True, {"deleted": deleted, "skipped": skipped, "errors": errors}
@@ -1,73 +1,284 @@
-from src.utils import setup_logger
-from src.config import Config
-from pathlib import Path
+from src.utils import setup_logger, get_registry, STATS, METRICS
+from src.config import Config, ArchiveStream
+from .ipam import AddressPool
+from .keypool import KeyPool
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, AsyncExitStack
+from itertools import islice
+from typing import Callable
 import subprocess
-import sys
+import asyncio
+import weakref
 import os
 
 from python_wireguard import Key
 
 logger = setup_logger('WireGuard')
+BATCH_SIZE = int(os.getenv('WG_BATCH_SIZE', 1000))
+PERSIST_CONFIG = os.getenv('WG_PERSIST_CONFIG', '1') not in ('0', 'false', 'no')
+POOL_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.wg.pool')
+# stored allowed-ips of a deactivated peer; live, only one peer can hold it, the others show `(none)`
+DEACTIVATED = '0.0.0.0/32'
+# the same for a peer the idle scheduler suspended, a value the API never writes
+SUSPENDED = '0.0.0.0/31'
 
 class WireGuard:
   def __init__(self) -> None: 
-    self.storage = Path(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.wg'))
-    self.storage.mkdir(parents=True, exist_ok=True)
-    
-  def _get_users(self):
-    users = {}
-    for entry in self.storage.iterdir():
-      if entry.is_dir():
-        pubkey_file = entry / 'public.key'
-        if pubkey_file.exists():
-          with open(pubkey_file, 'r') as f:
-            users[entry.name] = f.read().strip()
-    return users
-
-  def _save(self, filename, content) -> str:
-    path = self.storage / filename
-    folder = os.path.split(path)[0]
-    if not os.path.exists(folder):
-      os.makedirs(folder, exist_ok=True)
-    with open(path, 'w') as f:
-      f.write(content)
-    return path  
-    
+    self.registry = get_registry()
+    self.store = self.registry.store
+    self.storage = self.store.root
+    self._executor = ThreadPoolExecutor(max_workers=int(os.getenv('WG_WORKERS', 4)), thread_name_prefix='wg')
+    self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+    self._srv_pub: Key | None = None
+    self.keys = KeyPool(Key.key_pair)
+    subnet = os.getenv('WG_SUBNET')
+    # several web workers allocate from the same pool file
+    shared = int(os.getenv('WEB_WORKERS', 1)) > 1
+    self.pool = AddressPool(subnet, os.getenv('WG_POOL_FILE', POOL_FILE), os.getenv('WG_SERVER_IP'), shared) if subnet else None
+    self.pool_ready = asyncio.Event()
+    self.pool_ready.set()
+    self._rebuilding: asyncio.Task | None = None
+
+  async def start(self, app=None) -> None:
+    self.keys.start()
+
+  async def stop(self, app=None) -> None:
+    if self._rebuilding is not None:
+      self._rebuilding.cancel()
+      try: await self._rebuilding
+      except asyncio.CancelledError: pass
+      self._rebuilding = None
+    await self._io(self.keys.stop)
+
+  async def rebuild_pool(self, app=None) -> None:
+    """ Leader job: rebuilds the address pool from the live dump plus the stored peer addresses
+    in the background. New peers wait for it, everything else is served meanwhile """
+    if self.pool is None: return
+    self.pool_ready.clear()
+    self._rebuilding = asyncio.create_task(self._rebuild(app))
+
+  async def _rebuild(self, app) -> None:
+    try:
+      since = await self._io(self.pool.snapshot) if self.pool.shared else None
+      try:
+        peers = await app[STATS]._get_wg_stats() if app is not None else []
+      except Exception as e:
+        logger.error(f'Reading wg dump for the address pool failed: {e}')
+        peers = None
+      await self._io(self._rebuild_pool, peers, since)
+    except Exception as e:
+      logger.error(f'Rebuilding the address pool failed: {e}')
+    finally:
+      self.pool_ready.set()
+
+  def _rebuild_pool(self, peers: list[dict] | None, since: bytes = None) -> None:
+    addresses = [record['address'] for record in self.store.items() if record.get('address')]
+    if peers is None:
+      # without the live dump nothing is freed, every address taken so far is kept
+      self.pool.rebuild(addresses, since=bytes(len(self.pool.bitmap)))
+    else:
+      live = (ip for p in peers for ip in (p.get('allowed_ips') or '').split(',') if ip.endswith('/32'))
+      self.pool.rebuild([*addresses, *live], since=since)
+    self.pool.save()
+
+  async def _io(self, fn, *args):
+    """ Runs key generation and file I/O on the bounded executor """
+    return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+  @asynccontextmanager
+  async def _locked(self, *uuids):
+    """ Serializes operations on the same peers, unrelated peers proceed concurrently """
+    async with AsyncExitStack() as stack:
+      for uuid in sorted({u for u in uuids if u}):
+        lock = self._locks.get(uuid)
+        if lock is None:
+          lock = self._locks[uuid] = asyncio.Lock()
+        await stack.enter_async_context(lock)
+      yield
+
   def _load_key(self, filename: str) -> Key:
     return Key((self.storage / filename).read_text().strip())
+
+  @property
+  def server_public(self) -> Key:
+    if self._srv_pub is None:
+      self._srv_pub = self._load_key('server_public.key')
+    return self._srv_pub
+
+  def _persist_config(self, username, client) -> None:
+    try:
+      self.store.save_config(username, client)
+    except Exception as e:
+      logger.error(f'Saving {username} config failed: {e}')
   
-  def _create_keys(self, username) -> tuple[Key, Key]:
-    client_priv, client_pub = Key.key_pair()
-    self._save(f'{username}/private.key', str(client_priv))
-    self._save(f'{username}/public.key', str(client_pub))
-    return client_priv, client_pub
-   
+  def _address(self, uuid) -> str | None:
+    record = self.store.get(uuid)
+    return record and record.get('address')
+
+  def _save_pool(self) -> None:
+    """ The peer is live and stored by now; the pool file is rebuilt from the store at the next start """
+    try:
+      if self.pool: self.pool.save()
+    except Exception as e:
+      logger.error(f'Saving the address pool failed: {e}')
+
+  def _store_user(self, username, priv, pub, client, ip_addr, allowed_ips) -> str:
+    self.store.put(dict(uuid=username, pubkey=str(pub), privkey=str(priv), address=ip_addr, allowed_ips=allowed_ips))
+    self.registry.add(username, str(pub))
+    self._save_pool()
+    if PERSIST_CONFIG:
+      self._executor.submit(self._persist_config, username, client)
+    return client
+
+  def _forget_user(self, uuid) -> None:
+    address = self._address(uuid)
+    self.store.delete(uuid)
+    self.registry.remove(uuid)
+    if self.pool and address:
+      self.pool.release(address)
+      self._save_pool()
+
   @staticmethod
-  def _add_user_globally(client_pub, ip_addr, isolate) -> None:
-    allowed_ips = f"{ip_addr}/32" if isolate else f"{'.'.join(ip_addr.split('.')[:-1])}.0/24"
-    subprocess.run(['sudo', 'wg', 'set', os.getenv('INTERFACE'), 'peer', client_pub, 'allowed-ips', allowed_ips], check=True)
+  async def _wg_set(*clauses: list[str], check: bool = True) -> tuple[int, str]:
+    cmd = ['sudo', 'wg', 'set', os.getenv('INTERFACE')]
+    for clause in clauses:
+      cmd.extend(clause)
+    with METRICS.command('wg set'):
+      proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+      _, stderr = await proc.communicate()
+    stderr = stderr.decode(errors='replace').strip()
+    if check and proc.returncode:
+      raise subprocess.CalledProcessError(proc.returncode, cmd[:4], stderr=stderr)
+    return proc.returncode, stderr
+
+  @staticmethod
+  def _allowed_ips(ip_addr, isolate) -> str:
+    return f"{ip_addr}/32" if isolate else f"{'.'.join(ip_addr.split('.')[:-1])}.0/24"
+
+  def _assign(self, ip_addr) -> tuple[str, Callable | None]:
+    """ Picks an address from the pool when none is given; returns it with its undo """
+    if self.pool is None:
+      if not ip_addr: raise ValueError('ip_addr is required')
+      return ip_addr, None
+    if ip_addr:
+      if not self.pool.claim(ip_addr): raise ValueError(f'{ip_addr} is already in use')
+    else:
+      ip_addr = self.pool.allocate()
+    return ip_addr, lambda: self.pool.release(ip_addr)
+
+  async def _plan(self, action, uuid=None, username=None, ip_addr=None, isolate=True, **kwargs) -> tuple[list[str], Callable | None, Callable | None]:
+    """ Returns the `wg set` peer clause for an operation, what to persist once it is applied
+    and what to undo if it is not """
+    uuid = uuid or username
+    if action == 'add':
+      await self.pool_ready.wait()
+      ip_addr, rollback = await self._io(self._assign, ip_addr)
+      try:
+        priv, pub = self.keys.take() or await self._io(Key.key_pair)
+        srv_pub = self._srv_pub or await self._io(lambda: self.server_public)
+      except Exception:
+        if rollback: rollback()
+        raise
+      client = Config(priv, ip_addr, srv_pub).config
+      allowed_ips = self._allowed_ips(ip_addr, isolate)
+      clause = ['peer', str(pub), 'allowed-ips', allowed_ips]
+      return clause, lambda: self._store_user(uuid, priv, pub, client, ip_addr, allowed_ips), rollback
+    pubkey = self.registry.pubkey(uuid)
+    if action == 'deactivate':
+      marker = SUSPENDED if kwargs.get('suspend') else DEACTIVATED
+      return ['peer', pubkey, 'allowed-ips', marker], lambda: self.store.update(uuid, allowed_ips=marker), None
+    if action == 'reactivate':
+      # explicit allowed_ips restores a peer exactly (idle wake-ups), otherwise the address's /24
+      allowed_ips = kwargs.get('allowed_ips')
+      if not allowed_ips:
+        ip_addr = ip_addr or await self._io(self._address, uuid)
+        if not ip_addr: raise ValueError('ip_addr is required')
+        allowed_ips = f'{ip_addr}/24'
+      return ['peer', pubkey, 'allowed-ips', allowed_ips], lambda: self.store.update(uuid, allowed_ips=allowed_ips), None
+    if action == 'remove':
+      return ['peer', pubkey, 'remove'], lambda: self._forget_user(uuid), None
+    raise ValueError(f'Unknown action: {action}')
+
+  async def _apply(self, action, uuid, **kwargs):
+    async with self._locked(uuid):
+      clause, commit, rollback = await self._plan(action, uuid=uuid, **kwargs)
+      try:
+        await self._wg_set(clause)
+      except Exception:
+        if rollback: rollback()
+        raise
+      value = await self._io(commit) if commit else None
+      return True if value is None else value
     
-  def deactivate_peer(self, uuid, **kwargs) -> bool:
-    pubkeys = self._get_users()
-    subprocess.run(['sudo', 'wg', 'set', os.getenv('INTERFACE'), 'peer', pubkeys[uuid], 'allowed-ips', '0.0.0.0/32'], check=True)
-    return True
+  async def deactivate_peer(self, uuid, **kwargs) -> bool:
+    return await self._apply('deactivate', uuid)
   
-  def reactivate_peer(self, uuid, ip_addr, **kwargs) -> bool:
-    pubkeys = self._get_users()
-    subprocess.run(['sudo', 'wg', 'set', os.getenv('INTERFACE'), 'peer', pubkeys[uuid], 'allowed-ips', f'{ip_addr}/24'], check=True)
-    return True
+  async def reactivate_peer(self, uuid, ip_addr=None, **kwargs) -> bool:
+    return await self._apply('reactivate', uuid, ip_addr=ip_addr)
   
-  def remove_user(self, uuid, **kwargs) -> bool:
-    pubkeys = self._get_users()
-    subprocess.run(['sudo', 'wg', 'set', os.getenv('INTERFACE'), 'peer', pubkeys[uuid], 'allowed-ips', 'remove'], check=True)
+  async def remove_user(self, uuid, **kwargs) -> bool:
+    await self._apply('remove', uuid)
     return True
   
-  def add_user(self, username, ip_addr, isolate=True, **kwargs) -> tuple[str, str]:
-    priv, pub = self._create_keys(username)
-    srv_pub = self._load_key('server_public.key')
-    config = Config(priv, ip_addr, srv_pub)
-    client = config.config
-    conf_path = self._save(f'{username}/wg.conf', client)
-    self._add_user_globally(str(pub), ip_addr, isolate)
-    return conf_path, f'{username}.conf'
+  async def add_user(self, username, ip_addr=None, isolate=True, **kwargs) -> tuple[str, str]:
+    """ Returns the rendered client config and the filename to offer it as.
+    Without ip_addr the next free address of WG_SUBNET is assigned """
+    client = await self._apply('add', username, ip_addr=ip_addr, isolate=isolate)
+    return client, f'{username}.conf'
+
+  def _export_page(self, archive: ArchiveStream, records, page: int) -> tuple[bytes, int]:
+    count = 0
+    for record in islice(records, page):
+      count += 1
+      if not record or not record.get('privkey') or not record.get('address'): continue
+      archive.add(f"{record['uuid']}.conf", Config(record['privkey'], record['address'], self.server_public).config)
+    return archive.drain(), count
+
+  async def export(self, uuids: list[str] = None, format: str = 'zip', page: int = 500):
+    """ Yields a zip (or tar.gz) of the selected peers' configs, all peers by default, chunk by chunk.
+    Configs are rendered from the stored keys a page at a time, so memory does not grow with the peer count """
+    archive = ArchiveStream(format)
+    records = (self.store.get(uuid) for uuid in uuids) if uuids else self.store.items()
+    self._srv_pub = self._srv_pub or await self._io(lambda: self.server_public)
+    while True:
+      chunk, count = await self._io(self._export_page, archive, records, page)
+      if chunk: yield chunk
+      if count < page: break
+    yield await self._io(archive.close)
+
+  async def apply_clauses(self, clauses: list[list[str]]) -> list[str | None]:
+    """ Applies peer clauses with one `wg set` per BATCH_SIZE of them. If a combined call fails
+    its clauses are retried one by one; returns the error (or None) for every clause """
+    errors = [None] * len(clauses)
+    for i in range(0, len(clauses), BATCH_SIZE):
+      chunk = clauses[i:i + BATCH_SIZE]
+      code, stderr = await self._wg_set(*chunk, check=False)
+      if code == 0: continue
+      logger.error(f'Batch of {len(chunk)} peers failed, retrying one by one: {stderr}')
+      for j, clause in enumerate(chunk, i):
+        code, stderr = await self._wg_set(clause, check=False)
+        if code: errors[j] = stderr or f'wg set exited with {code}'
+    return errors
 
+  async def apply_batch(self, operations: list[dict]) -> list[dict]:
+    """ Applies many peer operations through `apply_clauses`, reporting ok/message per peer """
+    results = [dict(uuid=op.get('uuid') or op.get('username'), action=op.get('action'), ok=False) for op in operations]
+    async with self._locked(*(r['uuid'] for r in results)):
+      planned = []
+      plans = await asyncio.gather(*(self._plan(**op) for op in operations), return_exceptions=True)
+      for result, plan in zip(results, plans):
+        if isinstance(plan, Exception): result['message'] = str(plan)
+        else: planned.append((result, *plan))
+      errors = await self.apply_clauses([clause for _, clause, _, _ in planned])
+      for (result, _, commit, rollback), error in zip(planned, errors):
+        if error:
+          result['message'] = error
+          if rollback: rollback()
+          continue
+        try:
+          value = await self._io(commit) if commit else None
+          if isinstance(value, str): result['config'] = value
+          result['ok'] = True
+        except Exception as e:
+          result['message'] = str(e)
+    return results
@@ -1,3 +1,4 @@
-from .main import main
+from .main import main, leader
 
 rts = [*main]
+leader_rts = [*leader]
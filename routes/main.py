@@ -1,26 +1,31 @@
-from aiohttp.web import RouteTableDef, Request, json_response, Response, FileResponse
-from src.utils import Stats, setup_logger, create_passwd
-from src.modules import WireGuard, SquidManager
+from aiohttp.web import RouteTableDef, Request, json_response, Response, StreamResponse
+from src.utils import STATS, WG, SQUID, RECONCILER, IDLE, LEADER, STREAM_FIELDS, METRICS, setup_logger, create_passwd, parse_range
+from src.config import ArchiveStream
+import asyncio
+import json
+import time
 import os
 
 main = RouteTableDef()
-wg = WireGuard()
-squid = SquidManager()
+# served by the leader process to the other workers, see Leadership
+leader = RouteTableDef()
 logger = setup_logger('ROUTE|MAIN')
 
 
 @main.get('/status')
 async def handle_status(req: Request) -> Response:
-  return json_response(dict(status='success', body=dict(ok=True)))
+  body = dict(ok=True, keypool=req.app[WG].keys.stats, worker=os.getpid(), leader=req.app[LEADER].leader)
+  return json_response(dict(status='success', body=body))
 
 
 @main.post('/peer')
 async def handle_peer(req: Request) -> Response:
+  wg = req.app[WG]
   data = (await req.json()).get('data', {})
   try:
-    config_path, save_as = wg.add_user(**data)
-    return FileResponse(
-      config_path,
+    client, save_as = await wg.add_user(**data)
+    return Response(
+      text=client,
       headers={'Content-Disposition': f'attachment; filename="{save_as}"'}
     )
   except Exception as e:
@@ -30,9 +35,10 @@ async def handle_peer(req: Request) -> Response:
 
 @main.patch('/peer')
 async def edit_peer(req: Request) -> Response:
-  data = (await req.json()).get(data, {})
+  wg = req.app[WG]
+  data = (await req.json()).get('data', {})
   try:
-    success = getattr(wg, f'{data.pop("action")}_peer')(**data)
+    success = await getattr(wg, f'{data.pop("action")}_peer')(**data)
     return json_response(dict(status='success', body=success))
   except Exception as e:
     logger.error(str(e))
@@ -41,28 +47,196 @@ async def edit_peer(req: Request) -> Response:
 
 @main.delete('/peer')
 async def remove_peer(req: Request) -> Response:
+  wg = req.app[WG]
   uid = req.query.get('puid')
   try:
-    succeed = wg.remove_user(uid)
+    succeed = await wg.remove_user(uid)
     return json_response(dict(status='success', body=dict(ok=succeed)))
   except Exception as e:
     logger.error(str(e))
     return json_response(dict(status='error', message=str(e)), status=400)
 
 
+@main.post('/peer/wake')
+@leader.post('/peer/wake')
+async def wake_peer(req: Request) -> Response:
+  """ {data: {uuid}} or {data: {uuids: [...]}} reactivates suspended peers """
+  if req.app[LEADER].follower: return await req.app[LEADER].forward(req)
+  idle = req.app[IDLE]
+  data = (await req.json()).get('data', {})
+  uuids = (data.get('uuids') or [data.get('uuid')]) if isinstance(data, dict) else data
+  uuids = [u for u in uuids if u]
+  if not uuids:
+    return json_response(dict(status='error', message='At least one uuid is required!'), status=400)
+  try:
+    results = await idle.wake(uuids)
+    return json_response(dict(status='success' if all(r['ok'] for r in results) else 'error', body=results))
+  except Exception as e:
+    logger.error(str(e))
+    return json_response(dict(status='error', message=str(e)), status=400)
+
+
+@main.get('/peers/idle')
+@leader.get('/peers/idle')
+async def idle_peers(req: Request) -> Response:
+  if req.app[LEADER].follower: return await req.app[LEADER].forward(req)
+  idle = req.app[IDLE]
+  return json_response(dict(status='success', body=idle.status))
+
+
+@main.post('/peers/batch')
+async def batch_peers(req: Request) -> Response:
+  wg = req.app[WG]
+  operations = (await req.json()).get('data', [])
+  if not isinstance(operations, list):
+    return json_response(dict(status='error', message='List of operations is required!'), status=400)
+  try:
+    results = await wg.apply_batch(operations)
+    return json_response(dict(status='success' if all(r['ok'] for r in results) else 'error', body=results))
+  except Exception as e:
+    logger.error(str(e))
+    return json_response(dict(status='error', message=str(e)), status=400)
+
+
+@main.get('/peers/export')
+async def export_peers(req: Request) -> StreamResponse:
+  """ ?puid=a&puid=b (or puid=a,b) selects peers, all by default; ?format=zip|tar """
+  wg = req.app[WG]
+  puids = [p for value in req.query.getall('puid', []) for p in value.split(',') if p]
+  fmt = req.query.get('format', 'zip')
+  if fmt not in ArchiveStream.FORMATS:
+    return json_response(dict(status='error', message=f'format must be one of {", ".join(ArchiveStream.FORMATS)}'), status=400)
+  chunks = wg.export(puids or None, fmt)
+  try:
+    # the first page is rendered before the headers go out, so setup errors still get a 400
+    first = await anext(chunks)
+  except Exception as e:
+    logger.error(str(e))
+    return json_response(dict(status='error', message=str(e)), status=400)
+  resp = StreamResponse(headers={
+    'Content-Type': ArchiveStream.FORMATS[fmt],
+    'Content-Disposition': f'attachment; filename="peers.{ArchiveStream.EXTENSIONS[fmt]}"',
+  })
+  resp.enable_chunked_encoding()
+  await resp.prepare(req)
+  try:
+    await resp.write(first)
+    async for chunk in chunks:
+      await resp.write(chunk)
+  except ConnectionResetError:
+    return resp
+  except Exception as e:
+    # headers are already sent, a truncated archive is all the client can get
+    logger.error(f'Export failed: {e}')
+    raise
+  await resp.write_eof()
+  return resp
+
+
+@main.get('/peers/reconcile')
+async def reconcile_plan(req: Request) -> Response:
+  reconciler = req.app[RECONCILER]
+  try:
+    return json_response(dict(status='success', body=await reconciler.reconcile(dry_run=True)))
+  except Exception as e:
+    logger.error(str(e))
+    return json_response(dict(status='error', message=str(e)), status=400)
+
+
+@main.post('/peers/reconcile')
+async def reconcile_peers(req: Request) -> Response:
+  reconciler = req.app[RECONCILER]
+  try:
+    result = await reconciler.reconcile()
+    return json_response(dict(status='error' if result.get('failed') else 'success', body=result))
+  except Exception as e:
+    logger.error(str(e))
+    return json_response(dict(status='error', message=str(e)), status=400)
+
+
 @main.get('/stats')
+@leader.get('/stats')
 async def handle_stats(req: Request) -> Response:
+  """ ?since=<cursor> returns the peers changed after it; cursors are the leader's sampler's """
+  if req.app[LEADER].follower: return await req.app[LEADER].forward(req)
+  stats = req.app[STATS]
   try:
-    stats = Stats()
-    traffic = await stats.collect_stats()
-    return json_response(dict(status='success', body=traffic))
+    if stats.sampled_at is None or 'refresh' in req.query:
+      await stats.refresh()
+    since = req.query.get('since')
+    body = stats.since(int(since)) if since is not None else stats.snapshot
+    return json_response(dict(status='success', body=body, age=round(stats.age, 3), cursor=stats.cursor))
   except Exception as ex:
     logger.error(str(ex))
     return json_response(dict(status='error', message=str(ex)), status=400)
 
 
+@main.get('/stats/stream')
+@leader.get('/stats/stream')
+async def stream_stats(req: Request) -> StreamResponse:
+  """ Server-Sent Events: a `snapshot` frame (or the changes after Last-Event-ID), then a `delta`
+  frame with the changed peers after every sample. Rows follow `fields` of the `hello` event. """
+  if req.app[LEADER].follower: return await req.app[LEADER].forward(req)
+  stats = req.app[STATS]
+  if stats.sampled_at is None: await stats.refresh()
+  queue = stats.subscribe()
+  resp = StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+  try:
+    await resp.prepare(req)
+    await resp.write(f'event: hello\ndata: {json.dumps(dict(fields=STREAM_FIELDS, interval=stats.interval))}\n\n'.encode())
+    last = req.headers.get('Last-Event-ID')
+    if last and last.isdigit(): await resp.write(stats.frame('delta', stats.since(int(last))))
+    else: await resp.write(stats.frame('snapshot', stats.snapshot))
+    while True:
+      try:
+        frame = await asyncio.wait_for(queue.get(), timeout=max(15, stats.interval * 3))
+      except asyncio.TimeoutError:
+        await resp.write(b': keepalive\n\n')
+        continue
+      if frame is None:
+        await resp.write(b'event: dropped\ndata: {}\n\n')
+        break
+      await resp.write(frame)
+  except ConnectionResetError:
+    pass
+  finally:
+    stats.unsubscribe(queue)
+  return resp
+
+
+@main.get('/stats/history')
+@leader.get('/stats/history')
+async def handle_stats_history(req: Request) -> Response:
+  if req.app[LEADER].follower: return await req.app[LEADER].forward(req)
+  stats = req.app[STATS]
+  if stats.history is None:
+    return json_response(dict(status='error', message='History is off (STATS_HISTORY)'), status=404)
+  try:
+    history = stats.history.query(req.query['puid'], parse_range(req.query.get('range', '1h')), time.time())
+  except (KeyError, ValueError) as ex:
+    return json_response(dict(status='error', message=f'puid and a valid range are required ({ex})'), status=400)
+  if history is None:
+    return json_response(dict(status='error', message='No history for this peer'), status=404)
+  return json_response(dict(status='success', body=history))
+
+
+@main.get('/metrics')
+@leader.get('/metrics')
+async def handle_metrics(req: Request) -> Response:
+  """ Per-peer series come from the leader's sampler, request and loop series from every worker """
+  if req.app[LEADER].follower: return await req.app[LEADER].forward(req)
+  squid = req.app[SQUID]
+  try:
+    squid_users = len(await squid.passwd.names())
+  except Exception as ex:
+    logger.error(f'Could not count squid users: {ex}')
+    squid_users = None
+  return Response(body=METRICS.render(req.app[STATS], squid_users), content_type='text/plain', charset='utf-8')
+
+
 @main.post('/proxy/users')
 async def add_proxy_user(req: Request) -> Response:
+  squid = req.app[SQUID]
   data = (await req.json()).get('data', {})
   if not data.get('username'):
     return json_response(dict(status='error', mesasage='At least username is required!'), status=400)
@@ -72,8 +246,67 @@ async def add_proxy_user(req: Request) -> Response:
   return json_response(dict(status='success' if success else 'error', message=message, body=body), status=200 if success else 400)
 
 
+@main.post('/proxy/users/batch')
+async def add_proxy_users(req: Request) -> Response:
+  """ Accepts {data: {usernames: [...]}} or an NDJSON body of {"username": ...} lines.
+  Streams one NDJSON line per user as hashes complete, the last line reports the passwd commit. """
+  squid = req.app[SQUID]
+  if req.content_type == 'application/x-ndjson':
+    usernames, number = [], 0
+    async for line in req.content:
+      number += 1
+      if not line.strip(): continue
+      try:
+        usernames.append(json.loads(line).get('username'))
+      except (ValueError, AttributeError):
+        return json_response(dict(status='error', message=f'Line {number} is not a JSON object: {line[:100].decode(errors="replace").strip()}'), status=400)
+  else:
+    try:
+      body = await req.json()
+    except ValueError:
+      return json_response(dict(status='error', message='Body is not JSON'), status=400)
+    data = body.get('data', {}) if isinstance(body, dict) else None
+    usernames = data.get('usernames', []) if isinstance(data, dict) else data
+  if not isinstance(usernames, list):
+    return json_response(dict(status='error', message='List of usernames is required!'), status=400)
+  usernames = [u for u in usernames if u]
+  invalid = [u for u in usernames if not squid.valid_username(u)]
+  if invalid:
+    return json_response(dict(status='error', message=f'Invalid usernames: {", ".join(map(str, invalid))}'), status=400)
+  usernames = list(dict.fromkeys(usernames))
+  if not usernames:
+    return json_response(dict(status='error', message='At least one username is required!'), status=400)
+  credentials = {u: create_passwd(u) for u in usernames}
+  resp = StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+  await resp.prepare(req)
+  hashed = {}
+  async for chunk in squid.passwd.hash_stream({u: passwd for u, (passwd, _) in credentials.items()}):
+    hashed.update(chunk)
+    await resp.write(''.join(
+      json.dumps(dict(username=u, password=credentials[u][1], ip_address=os.getenv("LOCAL_IP"), port=os.getenv("SQUID_PORT"))) + '\n'
+      for u in chunk
+    ).encode())
+  success, message = await squid.commit_users(hashed)
+  await resp.write((json.dumps(dict(status='success' if success else 'error', message=message, count=len(hashed))) + '\n').encode())
+  await resp.write_eof()
+  return resp
+
+
+@main.get('/proxy/stats')
+async def proxy_stats(req: Request) -> Response:
+  squid = req.app[SQUID]
+  try:
+    hours = int(req.query.get('hours', 24))
+    body = await squid.traffic_stats(req.query.get('user'), hours)
+    return json_response(dict(status='success', body=body))
+  except Exception as e:
+    logger.error(str(e))
+    return json_response(dict(status='error', message=str(e)), status=400)
+
+
 @main.delete('/proxy/users')
 async def delete_proxy_user(req: Request) -> Response:
+  squid = req.app[SQUID]
   username = req.query.get('username')
   if not username:
     return json_response(dict(status='error', message='Username is required!'), status=400)
@@ -83,6 +316,7 @@ async def delete_proxy_user(req: Request) -> Response:
 
 @main.patch('/proxy/users')
 async def purge_proxy_users(req: Request) -> Response:
+  squid = req.app[SQUID]
   days = req.query.get('days', 30)
   success, body = await squid.purge_inactive(int(days))
   return json_response(dict(status='success' if success else 'error', body=body), status=200 if success else 400)
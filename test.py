@@ -1,11 +1,668 @@
 from utils.stats import test
+from utils import backends as nl
+from datetime import datetime, timezone
+import tempfile
+import asyncio
 import inspect
+import json
+import struct
+import base64
+import socket
+import subprocess
+import urllib.request
+import signal
+import time
 import sys
+import os
+import re
+
+
+def _src():
+  """ Makes the package importable as `src` for benches that need cross-package imports """
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  if root not in sys.path: sys.path.append(root)
+
+
+class _FakeNetlinkSocket:
+  """ Answers CTRL_CMD_GETFAMILY and WG_CMD_GET_DEVICE like the kernel would """
+  FAMILY = 0x20
+
+  def __init__(self, peers: list[dict], per_message: int = 32):
+    genl = struct.pack('=BBH', 1, 1, 0)
+    self.dump = [
+      self._msg(self.FAMILY, 0, genl + nl._attr(nl.WGDEVICE_A_PEERS, b''.join(self._peer(p) for p in peers[i:i + per_message])), 0x2)
+      for i in range(0, len(peers), per_message)
+    ] + [self._msg(nl.NLMSG_DONE, 0, struct.pack('=i', 0), 0x2)]
+    self.pending = []
+
+  @staticmethod
+  def _msg(typ, seq, payload, flags=0):
+    return struct.pack('=IHHII', 16 + len(payload), typ, flags, seq, 0) + payload
+
+  @staticmethod
+  def _peer(p):
+    ip = socket.inet_aton(p['ip'])
+    allowed = nl._attr(0, nl._attr(nl.WGALLOWEDIP_A_FAMILY, struct.pack('=H', socket.AF_INET))
+      + nl._attr(nl.WGALLOWEDIP_A_IPADDR, ip) + nl._attr(nl.WGALLOWEDIP_A_CIDR_MASK, b'\x20'))
+    return nl._attr(0,
+      nl._attr(nl.WGPEER_A_PUBLIC_KEY, base64.b64decode(p['pubkey']))
+      + nl._attr(nl.WGPEER_A_ENDPOINT, struct.pack('=H', socket.AF_INET) + struct.pack('!H', 51820) + ip + b'\0' * 8)
+      + nl._attr(nl.WGPEER_A_LAST_HANDSHAKE_TIME, struct.pack('=qq', p['handshake'], 0))
+      + nl._attr(nl.WGPEER_A_RX_BYTES, struct.pack('=Q', p['rx']))
+      + nl._attr(nl.WGPEER_A_TX_BYTES, struct.pack('=Q', p['tx']))
+      + nl._attr(nl.WGPEER_A_ALLOWEDIPS, allowed))
+
+  def send(self, data):
+    _, typ, _, seq, _ = struct.unpack_from('=IHHII', data)
+    genl = struct.pack('=BBH', 1, 1, 0)
+    if typ == nl.GENL_ID_CTRL:
+      family = nl._attr(nl.CTRL_ATTR_FAMILY_ID, struct.pack('=H', self.FAMILY))
+      self.pending = [self._msg(typ, seq, genl + family) + self._msg(nl.NLMSG_ERROR, seq, struct.pack('=i', 0) + data[:16])]
+      return len(data)
+    self.pending = list(self.dump)
+    return len(data)
+
+  def recv(self, bufsize):
+    return self.pending.pop(0) if self.pending else b''
+
+  def close(self):
+    pass
+
+
+def _synthetic_peers(count: int) -> list[dict]:
+  return [dict(
+    pubkey=base64.b64encode(i.to_bytes(32, 'big')).decode(),
+    ip=f'10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}',
+    handshake=1700000000 + i, rx=i * 1024, tx=i * 2048,
+  ) for i in range(count)]
+
+
+def _synthetic_dump(peers: list[dict]) -> bytes:
+  lines = ['PRIVATEKEYPRIVATEKEYPRIVATEKEYPRIVATEKEY= PUBLICKEYPUBLICKEYPUBLICKEYPUBLICKEYPUBL= 51820 off']
+  for p in peers:
+    lines.append(f"{p['pubkey']}\t(none)\t{p['ip']}:51820\t{p['ip']}/32\t{p['handshake']}\t{p['rx']}\t{p['tx']}\toff")
+  return '\n'.join(lines).encode()
+
+
+def _legacy_squid_parse(raw: str):
+  """ Line heuristics of the former SquidManager.get_last_activity_by_user, kept as a baseline """
+  parts = raw.split()
+  if len(parts) < 6:
+    m = re.search(r'\s([A-Za-z0-9_\-\.]{1,64})\s', raw)
+    if not m: return None
+    uname = m.group(1)
+  else:
+    uname = None
+    for idx in (6, 7, 8):
+      if idx < len(parts):
+        cand = parts[idx]
+        if cand != '-' and not cand.startswith('http') and not re.match(r'^\d+\.\d+\.\d+\.\d+$', cand):
+          uname = cand
+          break
+  if not uname: return None
+  m_ts = re.match(r'^(\d+\.\d+)', raw)
+  if m_ts: return uname, datetime.fromtimestamp(float(m_ts.group(1)), tz=timezone.utc)
+  m2 = re.search(r'\[(\d{1,2}/[A-Za-z]{3}/\d{4}:[^\]]+)\]', raw)
+  if m2: return uname, datetime.strptime(m2.group(1), "%d/%b/%Y:%H:%M:%S %z")
+  return uname, datetime.now(timezone.utc)
+
+
+def _synthetic_access_log(path: str, size_mb: int, users: int = 5000) -> int:
+  """ Writes a native-format squid access.log of roughly size_mb, returns the line count """
+  block = []
+  for i in range(10000):
+    user = f'user{i % users}' if i % 7 else '-'
+    block.append(
+      f'{1700000000 + i}.{i % 1000:03d}    {i % 900} 10.0.{(i >> 8) & 255}.{i & 255} TCP_TUNNEL/200 {i * 37 % 100000} '
+      f'CONNECT host{i % 300}.example.com:443 {user} HIER_DIRECT/93.184.216.{i % 255} -\n'
+    )
+  block = ''.join(block).encode()
+  target, lines = size_mb << 20, 0
+  with open(path, 'wb') as f:
+    while f.tell() < target:
+      f.write(block)
+      lines += 10000
+  return lines
 
 
 def test_stats():
   return test()
 
+
+class _FakeStore:
+  def __init__(self, records: dict):
+    self.records = records
+
+  def get(self, uuid): return self.records.get(uuid)
+  def items(self): return list(self.records.values())
+
+
+class _FakeWG:
+  """ Store plus a live interface where, like in the kernel, a prefix belongs to one peer only """
+  def __init__(self, records: dict, live: dict = None):
+    self.store = _FakeStore(records)
+    self.live = live if live is not None else {}
+    self.batches = []
+
+  async def _io(self, fn, *args): return fn(*args)
+
+  def _locked(self, *uuids):
+    from contextlib import nullcontext
+    return nullcontext()
+
+  def _set(self, pubkey: str, allowed_ips: str) -> None:
+    networks = set(allowed_ips.split(',')) - {''}
+    for other, held in self.live.items():
+      if other != pubkey: self.live[other] = ','.join(sorted(set(held.split(',')) - networks - {'(none)', ''})) or '(none)'
+    self.live[pubkey] = allowed_ips or '(none)'
+
+  async def apply_clauses(self, clauses):
+    for _, pubkey, _, allowed_ips in clauses: self._set(pubkey, allowed_ips)
+    return [None] * len(clauses)
+
+  async def apply_batch(self, operations):
+    """ deactivate/reactivate with the markers and store writes of WireGuard._plan """
+    from src.modules.wg import DEACTIVATED, SUSPENDED
+    self.batches.append(operations)
+    results = []
+    for op in operations:
+      record = self.store.records[op['uuid']]
+      if op['action'] == 'deactivate': allowed_ips = SUSPENDED if op.get('suspend') else DEACTIVATED
+      else: allowed_ips = op.get('allowed_ips') or f"{record['address']}/24"
+      self._set(record['pubkey'], allowed_ips)
+      record['allowed_ips'] = allowed_ips
+      results.append(dict(uuid=op['uuid'], action=op['action'], ok=True))
+    return results
+
+
+def test_reconciler():
+  """ Drift is fixed once, a /24 shared by two stored peers is reported and left where it is """
+  _src()
+  from src.modules.reconciler import Reconciler
+  from src.modules.wg import DEACTIVATED
+  records = {
+    'a': dict(uuid='a', pubkey='A', allowed_ips='10.8.0.2/24'),
+    'b': dict(uuid='b', pubkey='B', allowed_ips='10.8.0.3/24'),
+    'c': dict(uuid='c', pubkey='C', allowed_ips='10.8.0.4/32'),
+    'd': dict(uuid='d', pubkey='D', allowed_ips=DEACTIVATED),
+    'e': dict(uuid='e', pubkey='E', allowed_ips=None),
+  }
+  wg = _FakeWG(records, {'A': '(none)', 'B': '10.8.0.0/24', 'C': '10.8.0.9/32', 'D': '(none)', 'E': '10.8.0.5/32', 'X': '10.8.0.7/32'})
+
+  class _Stats:
+    async def _get_wg_stats(self): return [dict(pubkey=k, allowed_ips=v) for k, v in wg.live.items()]
+
+  reconciler = Reconciler(wg, interval=0, prune=False, stats=_Stats())
+  passes = [asyncio.run(reconciler.reconcile()) for _ in range(3)]
+  assert [u['uuid'] for u in passes[0]['update']] == ['c'], passes[0]
+  assert not passes[1]['update'] and not passes[1]['add'] and not passes[2]['update']
+  assert [c['uuid'] for c in passes[2]['conflicts']] == ['a', 'b']
+  assert passes[2]['unknown'] == ['e'] and [u['pubkey'] for u in passes[2]['unmanaged']] == ['X']
+  assert wg.live['B'] == '10.8.0.0/24' and wg.live['C'] == '10.8.0.4/32'
+  return dict(updates=[len(p['update']) for p in passes], conflicts=passes[2]['conflicts'])
+
+
+def test_idle_scheduler():
+  """ Suspension restores the peer's own allowed-ips; API deactivations are never undone """
+  _src()
+  from src.modules.idle import IdleScheduler
+  from src.modules.wg import DEACTIVATED, SUSPENDED
+  records = {
+    'p1': dict(uuid='p1', pubkey='P1', address='10.8.0.2', allowed_ips='10.8.0.2/32'),
+    'p2': dict(uuid='p2', pubkey='P2', address='10.8.0.3', allowed_ips='10.8.0.3/32'),
+    'p3': dict(uuid='p3', pubkey='P3', address='10.8.0.4', allowed_ips=DEACTIVATED),
+  }
+  wg = _FakeWG(records)
+  with tempfile.TemporaryDirectory() as tmp:
+    idle = IdleScheduler(wg, idle_after=60, state_file=os.path.join(tmp, 'idle.json'))
+    idle.owner = True
+
+    async def scenario():
+      idle.observe({puid: dict(latest_handshake=100) for puid in records}, 100)
+      await idle.suspend(idle.due(200))
+      assert sorted(idle.suspended) == ['p1', 'p2'] and records['p1']['allowed_ips'] == SUSPENDED
+      assert records['p3']['allowed_ips'] == DEACTIVATED
+      # the control plane deactivates p2 while it is suspended
+      await wg.apply_batch([dict(action='deactivate', uuid='p2')])
+      wake = idle.observe({puid: dict(latest_handshake=300) for puid in records}, 300)
+      results = await idle.wake(wake + ['p3'])
+      return {r['uuid']: r['ok'] for r in results}
+
+    woken = asyncio.run(scenario())
+    saved = json.loads(open(idle.state_file).read())
+  assert woken == dict(p1=True, p2=False, p3=False), woken
+  assert records['p1']['allowed_ips'] == '10.8.0.2/32' and wg.live['P1'] == '10.8.0.2/32'
+  assert records['p2']['allowed_ips'] == DEACTIVATED and records['p3']['allowed_ips'] == DEACTIVATED
+  assert not idle.suspended and saved == {}
+  return dict(woken=woken, batches=len(wg.batches))
+
+
+def test_address_pool():
+  """ Concurrent allocate + save from executor threads: unique addresses, the file matches the bitmap """
+  _src()
+  from src.modules.ipam import AddressPool
+  from concurrent.futures import ThreadPoolExecutor
+
+  def add(pool):
+    ip = pool.allocate()
+    pool.save()
+    return ip
+
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for shared in (False, True):
+      path = os.path.join(tmp, f'pool-{shared}')
+      pool = AddressPool('10.8.0.0/22', path, shared=shared)
+      with ThreadPoolExecutor(8) as executor:
+        ips = list(executor.map(lambda _: add(pool), range(800)))
+      assert len(set(ips)) == len(ips) == 800
+      with open(path, 'rb') as f: assert f.read() == bytes(pool.bitmap)
+      assert AddressPool('10.8.0.0/22', path).snapshot() == bytes(pool.bitmap)
+      assert [name for name in os.listdir(tmp) if name.endswith('.tmp')] == []
+      results['shared' if shared else 'local'] = len(ips)
+  return results
+
+
+def test_access_log_follower():
+  """ Rename rotation (with late writes to the old file), copytruncate and over-long lines """
+  _src()
+  from src.modules.access_log import AccessLogFollower
+
+  class _Lines:
+    name = 'lines'
+    def __init__(self): self.lines = []
+    def feed(self, lines): self.lines.extend(lines)
+    def state(self): return None
+    def load(self, state): pass
+
+  def write(path, *lines, mode='ab'):
+    with open(path, mode) as f: f.write(b''.join(line + b'\n' for line in lines))
+
+  consumer = _Lines()
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'access.log')
+    follower = AccessLogFollower(path, [consumer], state_file=os.path.join(tmp, 'state.json'))
+    follower.CHUNK = 64
+    write(path, b'one', b'two')
+    follower._poll()
+    # squid writes to the renamed file before it reopens the log
+    os.rename(path, f'{path}.1')
+    write(f'{path}.1', b'three')
+    write(path, b'four')
+    follower._poll()
+    write(path, b'x' * 200, b'five')
+    follower._poll()
+    write(path, b'six', mode='wb')
+    follower._poll()
+    follower._fh.close()
+  assert consumer.lines == [b'one', b'two', b'three', b'four', b'five', b'six'], consumer.lines
+  return dict(lines=len(consumer.lines))
+
+
+def test_apr1():
+  """ Known `openssl passwd -apr1` hashes """
+  _src()
+  from src.modules.squid import apr1
+  vectors = {
+    ('password', 'r31....'): '$apr1$r31....$kMmt8Ia8qcWk4vKKEhpgx1',
+    ('correct horse battery staple', 'saltsalt'): '$apr1$saltsalt$PU9q8.HoFJEM7m9NSIooE1',
+    ('', 'xy'): '$apr1$xy$43..WIhbfuznGvwoCyUek/',
+  }
+  for (password, salt), expected in vectors.items():
+    assert apr1(password, salt) == expected, (password, apr1(password, salt))
+  return dict(vectors=len(vectors))
+
+def bench_stats_backends(rounds: int = 5):
+  """ ms per sample for `wg show dump` parsing vs netlink at 100/1k/10k peers.
+  `spawn` is the cost of forking `true`, a lower bound for what `sudo wg` adds on top of `dump` """
+  start = time.perf_counter()
+  for _ in range(rounds): subprocess.run(['true'])
+  results = dict(spawn=round((time.perf_counter() - start) / rounds * 1000, 3))
+  for count in (100, 1000, 10000):
+    peers = _synthetic_peers(count)
+    dump, raw = nl.DumpBackend('wg0'), _synthetic_dump(peers)
+    sock = _FakeNetlinkSocket(peers)
+    netlink = nl.NetlinkBackend('wg0', sock_factory=lambda: sock)
+    assert dump.parse(raw) == netlink.dump()
+    timings = {}
+    for name, fn in (('dump', lambda: dump.parse(raw)), ('netlink', netlink.dump)):
+      start = time.perf_counter()
+      for _ in range(rounds): fn()
+      timings[name] = round((time.perf_counter() - start) / rounds * 1000, 3)
+    results[count] = timings
+  return results
+
+def bench_squid_parser(size_mb: int = None):
+  """ Lines/sec of the positional parser vs the old heuristics on a generated access.log (BENCH_LOG_MB, default 1024) """
+  _src()
+  from src.modules.access_log import SquidLogParser
+  size_mb = size_mb or int(os.getenv('BENCH_LOG_MB', 1024))
+  parser = SquidLogParser('squid')
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'access.log')
+    lines = _synthetic_access_log(path, size_mb)
+    results = dict(size_mb=size_mb, lines=lines)
+    for name, parse in (('legacy', lambda line: _legacy_squid_parse(line.decode(errors='ignore'))), ('positional', parser)):
+      start = time.perf_counter()
+      with open(path, 'rb') as f:
+        for line in f: parse(line)
+      results[name] = int(lines / (time.perf_counter() - start))
+  return results
+
+
+def bench_address_pool():
+  """ Allocates every address of a /16, then frees and re-allocates a scattered tenth """
+  _src()
+  from src.modules.ipam import AddressPool
+  with tempfile.TemporaryDirectory() as tmp:
+    pool = AddressPool('10.8.0.0/16', os.path.join(tmp, 'pool'))
+    start = time.perf_counter()
+    allocated = []
+    while True:
+      try: allocated.append(pool.allocate())
+      except RuntimeError: break
+    full = time.perf_counter() - start
+    freed = allocated[::10]
+    for ip in freed: pool.release(ip)
+    start = time.perf_counter()
+    for _ in freed: pool.allocate()
+    churn = time.perf_counter() - start
+    start = time.perf_counter()
+    pool.save()
+    save = time.perf_counter() - start
+  return dict(
+    allocated=len(allocated), full_s=round(full, 3), per_alloc_us=round(full / len(allocated) * 1e6, 2),
+    churn_per_alloc_us=round(churn / len(freed) * 1e6, 2), save_ms=round(save * 1000, 3),
+  )
+
+
+def bench_peer_store(count: int = 100000, lookups: int = 10000):
+  """ Inserts, uuid/pubkey lookups and a full uuid->pubkey load for both peer store backends """
+  from utils.store import DirectoryStore, SQLiteStore
+  peers = _synthetic_peers(count)
+  records = [dict(uuid=f'peer-{i}', pubkey=p['pubkey'], privkey=p['pubkey'], address=p['ip'], allowed_ips=f"{p['ip']}/32") for i, p in enumerate(peers)]
+  probe = records[::max(1, count // lookups)]
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for name, store in (('sqlite', SQLiteStore(os.path.join(tmp, 'peers.db'), root=tmp)), ('dir', DirectoryStore(os.path.join(tmp, 'wg')))):
+      timings = {}
+      start = time.perf_counter()
+      for record in records: store.put(record)
+      timings['insert_per_s'] = int(count / (time.perf_counter() - start))
+      start = time.perf_counter()
+      for record in probe: store.get(record['uuid'])
+      timings['get_uuid_us'] = round((time.perf_counter() - start) / len(probe) * 1e6, 2)
+      start = time.perf_counter()
+      pubkeys = store.pubkeys()
+      timings['load_all_s'] = round(time.perf_counter() - start, 3)
+      if hasattr(store, 'get_by_pubkey'):
+        start = time.perf_counter()
+        for record in probe: store.get_by_pubkey(record['pubkey'])
+        timings['get_pubkey_us'] = round((time.perf_counter() - start) / len(probe) * 1e6, 2)
+      assert len(pubkeys) == count
+      store.close()
+      results[name] = timings
+  return dict(count=count, **results)
+
+
+def bench_stats_history(peers: int = 5000, samples: int = 720):
+  """ Records an hour of 5s samples for every peer, then queries each tier """
+  from utils.history import PeerHistory
+  history = PeerHistory()
+  batch = {f'peer-{i}': dict(delta_received=i, delta_sent=i // 2, latest_handshake=0) for i in range(peers)}
+  now = time.time()
+  start = time.perf_counter()
+  for step in range(samples):
+    history.record(batch, now + step * 5)
+  record = time.perf_counter() - start
+  now += samples * 5
+  timings = {}
+  for label, seconds in (('5m', 300), ('6h', 21600), ('7d', 604800)):
+    start = time.perf_counter()
+    for i in range(0, peers, max(1, peers // 100)): history.query(f'peer-{i}', seconds, now)
+    timings[f'query_{label}_us'] = round((time.perf_counter() - start) / 100 * 1e6, 2)
+  memory = sum(arr.itemsize * len(arr) for tier in history.tiers for arr in (tier.received, tier.sent, tier.handshake))
+  return dict(peers=peers, record_ms=round(record / samples * 1000, 3), memory_mb=round(memory / 2**20, 1), **timings)
+
+
+def bench_metrics_render(peers: int = 10000, scrapes: int = 50):
+  """ /metrics body for `peers` peers: first render after a sample vs cached scrapes """
+  from utils.metrics import Metrics
+  class _Stats:
+    cursor = 1
+    snapshot = {f'peer-{i}': dict(received=i * 1000, sent=i * 10, latest_handshake=1700000000 + i) for i in range(peers)}
+  metrics, stats = Metrics(), _Stats()
+  for i in range(1000): metrics.requests.observe(i / 1000, 'GET', '/stats', 200)
+  start = time.perf_counter()
+  body = metrics.render(stats, 0)
+  first = time.perf_counter() - start
+  start = time.perf_counter()
+  for _ in range(scrapes): metrics.render(stats, 0)
+  cached = (time.perf_counter() - start) / scrapes
+  return dict(peers=peers, size_kb=len(body) // 1024, first_ms=round(first * 1000, 2), cached_ms=round(cached * 1000, 3))
+
+
+def _fake_bin(folder: str) -> str:
+  """ Stand-ins for sudo, wg and squid: sleep BENCH_LATENCY seconds, `wg show` prints BENCH_WG_DUMP """
+  scripts = dict(
+    sudo='exec "$@"\n',
+    wg='sleep "$BENCH_LATENCY"\n[ "$1" = show ] && exec cat "$BENCH_WG_DUMP"\nexit 0\n',
+    squid='sleep "$BENCH_LATENCY"\n',
+  )
+  os.makedirs(folder, exist_ok=True)
+  for name, body in scripts.items():
+    path = os.path.join(folder, name)
+    with open(path, 'w') as f: f.write('#!/bin/sh\n' + body)
+    os.chmod(path, 0o755)
+  return folder
+
+
+def _bench_env(tmp: str, peers: int, latency: float) -> dict:
+  """ Synthetic peer store, `wg show dump`, access.log and passwd file under `tmp` """
+  from utils.store import SQLiteStore
+  storage = os.path.join(tmp, 'wg')
+  synthetic = _synthetic_peers(peers)
+  store = SQLiteStore(os.path.join(storage, 'peers.db'), root=storage)
+  store.put_many(dict(uuid=f'peer-{i}', pubkey=p['pubkey'], privkey=p['pubkey'], address=p['ip'], allowed_ips=f"{p['ip']}/32") for i, p in enumerate(synthetic))
+  store.close()
+  with open(os.path.join(storage, 'server_public.key'), 'w') as f: f.write(base64.b64encode(bytes(32)).decode())
+  with open(os.path.join(tmp, 'dump'), 'wb') as f: f.write(_synthetic_dump(synthetic))
+  _synthetic_access_log(os.path.join(tmp, 'access.log'), 8)
+  open(os.path.join(tmp, 'passwd'), 'w').close()
+  os.makedirs(os.path.join(tmp, 'logs'), exist_ok=True)
+  bin_dir = _fake_bin(os.path.join(tmp, 'bin'))
+  return dict(
+    PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}", BENCH_LATENCY=str(latency), BENCH_WG_DUMP=os.path.join(tmp, 'dump'),
+    INTERFACE='wgbench', STATS_BACKEND='dump', WG_STORE='sqlite', WG_STORAGE=storage, WG_STORE_PATH=os.path.join(storage, 'peers.db'),
+    WG_POOL_FILE=os.path.join(tmp, 'pool'), WG_SUBNET='10.0.0.0/8', WG_PERSIST_CONFIG='0', WG_RECONCILE_INTERVAL='0',
+    SQUID_PASSWD_FILE=os.path.join(tmp, 'passwd'), SQUID_ACCESS_LOG=os.path.join(tmp, 'access.log'),
+    SQUID_STATE_FILE=os.path.join(tmp, 'access_state.json'), SQUID_RELOAD_CMD=os.path.join(bin_dir, 'squid'),
+  )
+
+
+def _percentile(ordered: list[float], q: float) -> float:
+  return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def _load(session, url: str, method: str, body, requests: int, concurrency: int) -> dict:
+  latencies, errors, counter = [], 0, iter(range(requests))
+
+  async def worker():
+    nonlocal errors
+    for i in counter:
+      start = time.perf_counter()
+      async with session.request(method, url, json=body(i) if body else None) as resp:
+        await resp.read()
+        if resp.status >= 300: errors += 1
+      latencies.append(time.perf_counter() - start)
+
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  elapsed = time.perf_counter() - start
+  latencies.sort()
+  return dict(
+    requests=requests, errors=errors, rps=round(requests / elapsed, 1),
+    p50_ms=round(_percentile(latencies, 0.5) * 1000, 2), p99_ms=round(_percentile(latencies, 0.99) * 1000, 2),
+    max_ms=round(latencies[-1] * 1000, 2) if latencies else 0,
+  )
+
+
+async def _drive_app(requests: int, concurrency: int) -> dict:
+  _src()
+  import src
+  from src.utils import TokenFile
+  from aiohttp import ClientSession
+  from aiohttp.test_utils import TestServer
+  token = 'b' * 32
+  with open('.uuid', 'w') as f: f.write(token)
+  src.settings.tokens = TokenFile(os.path.abspath('.uuid'))
+  server = TestServer(src.create_app())
+  await server.start_server()
+  scenarios = (
+    ('stats', 'GET', '/stats', None),
+    ('stats_refresh', 'GET', '/stats?refresh=1', None),
+    ('peer', 'POST', '/peer', lambda i: dict(data=dict(username=f'bench-peer-{i}'))),
+    ('proxy_users', 'POST', '/proxy/users', lambda i: dict(data=dict(username=f'bench-user-{i}'))),
+  )
+  try:
+    async with ClientSession(headers={'Authorization': f'Bearer {token}'}) as session:
+      return {
+        name: await _load(session, str(server.make_url(path)), method, body, requests, concurrency)
+        for name, method, path, body in scenarios
+      }
+  finally:
+    await server.close()
+
+
+def bench_app():
+  """ Drives create_app() over HTTP with fake sudo/wg/squid and synthetic data.
+  BENCH_PEERS, BENCH_REQUESTS, BENCH_CONCURRENCY, BENCH_LATENCY (seconds per fake command);
+  BENCH_OUT writes the result as JSON for diffing between releases """
+  config = dict(
+    peers=int(os.getenv('BENCH_PEERS', 10000)), requests=int(os.getenv('BENCH_REQUESTS', 500)),
+    concurrency=int(os.getenv('BENCH_CONCURRENCY', 32)), latency=float(os.getenv('BENCH_LATENCY', 0.005)),
+  )
+  saved_env, cwd = dict(os.environ), os.getcwd()
+  with tempfile.TemporaryDirectory(prefix='wg-bench-') as tmp:
+    os.environ.update(_bench_env(tmp, config['peers'], config['latency']))
+    os.chdir(tmp)
+    try:
+      results = asyncio.run(_drive_app(config['requests'], config['concurrency']))
+    finally:
+      os.chdir(cwd)
+      os.environ.clear()
+      os.environ.update(saved_env)
+  report = dict(config=config, python=sys.version.split()[0], results=results)
+  if os.getenv('BENCH_OUT'):
+    with open(os.getenv('BENCH_OUT'), 'w') as f: json.dump(report, f, indent=2, sort_keys=True)
+  return report
+
+
+_STARTUP_PHASES = """
+import asyncio, json, time
+start = time.perf_counter()
+import src
+imported = time.perf_counter()
+app = src.create_app()
+created = time.perf_counter()
+from aiohttp.web import AppRunner
+async def startup():
+  runner = AppRunner(app)
+  await runner.setup()
+  ready = time.perf_counter()
+  await runner.cleanup()
+  return ready
+ready = asyncio.run(startup())
+print(json.dumps(dict(import_ms=(imported - start) * 1000, create_app_ms=(created - imported) * 1000, startup_ms=(ready - created) * 1000)))
+"""
+
+_STARTUP_RUN = "import os, src; from src.utils import TokenFile; src.settings.tokens = TokenFile(os.path.abspath('.uuid')); src.run()"
+
+
+def _free_port() -> int:
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+
+def _time_to_ready(env: dict, cwd: str, workers: int, token: str, timeout: float = 60) -> dict:
+  """ Spawns `run()` and polls /status until `workers` different workers have answered """
+  port = _free_port()
+  start = time.perf_counter()
+  proc = subprocess.Popen([sys.executable, '-c', _STARTUP_RUN], cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    env={**env, 'WEB_PORT': str(port), 'WEB_WORKERS': str(workers)})
+  first, seen = None, set()
+  try:
+    while len(seen) < workers and time.perf_counter() - start < timeout:
+      request = urllib.request.Request(f'http://127.0.0.1:{port}/status', headers={'Authorization': f'Bearer {token}'})
+      try:
+        with urllib.request.urlopen(request, timeout=5) as resp:
+          seen.add(json.load(resp)['body']['worker'])
+          first = first or time.perf_counter() - start
+      except OSError:
+        time.sleep(0.01)
+    return dict(workers=workers, first_ms=round(first * 1000, 1) if first else None, all_ms=round((time.perf_counter() - start) * 1000, 1) if len(seen) == workers else None)
+  finally:
+    proc.send_signal(signal.SIGTERM)
+    try: proc.wait(timeout=30)
+    except subprocess.TimeoutExpired: proc.kill()
+
+
+def bench_startup():
+  """ Cold start against BENCH_PEERS stored peers: import, create_app() and app startup in a fresh
+  interpreter (best of BENCH_ROUNDS), then the time until `run()` answers /status with one worker
+  and with BENCH_WORKERS workers """
+  config = dict(peers=int(os.getenv('BENCH_PEERS', 50000)), rounds=int(os.getenv('BENCH_ROUNDS', 3)), workers=int(os.getenv('BENCH_WORKERS', 4)))
+  _src()
+  token = 'b' * 32
+  with tempfile.TemporaryDirectory(prefix='wg-startup-') as tmp:
+    env = {**os.environ, **_bench_env(tmp, config['peers'], 0), 'PYTHONPATH': os.pathsep.join(p for p in sys.path if p), 'WEB_LEADER_LOCK': os.path.join(tmp, 'leader'), 'WG_IDLE_STATE': os.path.join(tmp, 'idle.json')}
+    with open(os.path.join(tmp, '.uuid'), 'w') as f: f.write(token)
+    phases = [
+      json.loads(subprocess.run([sys.executable, '-c', _STARTUP_PHASES], cwd=tmp, env=env, capture_output=True, text=True, check=True).stdout)
+      for _ in range(config['rounds'])
+    ]
+    best = {phase: round(min(p[phase] for p in phases), 1) for phase in phases[0]}
+    ready = [_time_to_ready(env, tmp, workers, token) for workers in sorted({1, config['workers']})]
+  return dict(config=config, phases=best, ready=ready)
+
+
+def bench_idle_scheduler(peers: int = 100000, due: int = 1000):
+  """ Feeding `peers` handshakes into the idle heap, then one tick where `due` of them expire """
+  _src()
+  from src.modules.idle import IdleScheduler
+  scheduler = IdleScheduler(None, idle_after=3600, state_file=os.path.join(tempfile.gettempdir(), f'bench-idle-{os.getpid()}.json'))
+  now = time.time()
+  snapshot = {f'peer-{i}': dict(latest_handshake=int(now - (3700 if i < due else i % 3000))) for i in range(peers)}
+  start = time.perf_counter()
+  scheduler.observe(snapshot, now)
+  observe = time.perf_counter() - start
+  start = time.perf_counter()
+  expired = scheduler.due(now)
+  tick = time.perf_counter() - start
+  start = time.perf_counter()
+  scheduler.due(now)
+  idle_tick = time.perf_counter() - start
+  assert len(expired) == due
+  return dict(peers=peers, due=due, observe_ms=round(observe * 1000, 2), tick_ms=round(tick * 1000, 3), idle_tick_us=round(idle_tick * 1e6, 2))
+
+
+def bench_proxy_traffic(size_mb: int = 32):
+  """ Lines per second through the hourly traffic aggregator, and its bucket count afterwards """
+  _src()
+  from src.modules.access_log import SquidLogParser, TrafficIndex
+  traffic = TrafficIndex(SquidLogParser('squid').record)
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'access.log')
+    lines = _synthetic_access_log(path, size_mb)
+    with open(path, 'rb') as f: data = f.read().split(b'\n')
+  start = time.perf_counter()
+  for i in range(0, len(data), 10000): traffic.feed(data[i:i + 10000])
+  elapsed = time.perf_counter() - start
+  users = sum(len(bucket) for bucket in traffic.buckets.values())
+  return dict(lines=lines, lines_per_s=int(lines / elapsed), hours=len(traffic.buckets), user_hours=users)
+
+
 def _get_all_tasks():
   current_module = sys.modules[__name__]
   funcs = {}
@@ -32,6 +689,8 @@ def main():
       print(f'Result:', fn())
   else:
     for name, fn in funcs.items():
+      # benches generate large fixtures and start servers, they run only when named
+      if name.startswith('bench_'): continue
       print(f'Executing {name}!')
       print('Result:', fn())
 
@@ -1,4 +1,10 @@
-from .stats import Stats
+from .stats import Stats, STREAM_FIELDS
+from .history import PeerHistory, parse_range
+from .store import PeerStore, DirectoryStore, SQLiteStore, get_store
+from .registry import PeerRegistry, get_registry
 from .logger import setup_logger
-from .middlewares import middlewares
+from .middlewares import middlewares, TokenFile
 from .core import create_passwd
+from .context import STATS, LEADER, WG, SQUID, RECONCILER, IDLE
+from .leader import Leadership
+from .metrics import METRICS
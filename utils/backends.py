@@ -0,0 +1,241 @@
+from .metrics import METRICS
+import asyncio
+import base64
+import socket
+import struct
+import re
+import os
+
+NETLINK_GENERIC = 16
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLA_TYPE_MASK = 0x3fff
+
+WG_GENL_NAME = b'wireguard'
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+
+_NLMSGHDR = struct.Struct('=IHHII')
+_GENLMSGHDR = struct.Struct('=BBH')
+_NLATTR = struct.Struct('=HH')
+_S64 = struct.Struct('=q')
+_U64 = struct.Struct('=Q')
+
+
+def _to_int(val: str) -> int:
+  try: return int(val)
+  except Exception: return 0
+
+def _is_endpoint(endpoint: str = None) -> str | None:
+  if not endpoint or endpoint == '(none)': return None
+  if endpoint.count(":") >= 2 and endpoint.startswith("[") and "]:" in endpoint:
+    host = endpoint.split("]:", 1)[0].lstrip("[")
+    port = endpoint.split("]:", 1)[1]
+    endpoint_ip = host.strip()
+    endpoint_port = _to_int(port.strip())
+    ep = f'{endpoint_ip}:{endpoint_port}'
+  elif ":" in endpoint:
+    host, port = endpoint.rsplit(":", 1)
+    endpoint_ip = host.strip()
+    endpoint_port = _to_int(port.strip())
+    ep = f'{endpoint_ip}:{endpoint_port}'
+  else:
+    ep = endpoint.strip()
+  return ep
+
+
+class DumpBackend:
+  """ Parses `sudo wg show <iface> dump` """
+  name = 'dump'
+
+  def __init__(self, interface: str) -> None:
+    self.interface = interface
+    self._WS = re.compile(r"\s+")
+
+  _PUBKEY = re.compile(r'[A-Za-z0-9+/=]{20,}')
+
+  @classmethod
+  def _is_pubkey(cls, token: str) -> bool:
+    return cls._PUBKEY.fullmatch(token) is not None
+
+  def parse(self, stdout: bytes) -> list[dict]:
+    stats = []
+    start_idx = 1
+    lines = [ln.rstrip("\n") for ln in stdout.decode('utf-8', errors='replace').splitlines() if ln.strip()]
+    if not lines: return []
+    for line in lines[start_idx:]:
+      data = {}
+      tokens = self._WS.split(line.strip())
+      if not tokens or not self._is_pubkey(tokens[0]): continue
+      data['pubkey'] = tokens[0] if tokens else None
+      data['endpoint'] = _is_endpoint(tokens[2]) if len(tokens) > 2 else None
+      data['allowed_ips'] = tokens[3] if len(tokens) > 3 else None
+      data['latest_handshake'] = _to_int(tokens[4]) if len(tokens) > 3 else None
+      data['received'] = _to_int(tokens[5]) if len(tokens) > 5 else "0"
+      data['sent'] = _to_int(tokens[6]) if len(tokens) > 6 else "0"
+      stats.append(data)
+    return stats
+
+  async def peers(self) -> list[dict]:
+    with METRICS.command('wg show'):
+      proc = await asyncio.create_subprocess_exec(
+        'sudo', 'wg', 'show', self.interface, 'dump',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+      )
+      stdout, _ = await proc.communicate()
+    return self.parse(stdout)
+
+
+def _attrs(buf: memoryview, off: int = 0, end: int = None):
+  end = len(buf) if end is None else end
+  while off + 4 <= end:
+    length, typ = _NLATTR.unpack_from(buf, off)
+    if length < 4: break
+    yield typ & NLA_TYPE_MASK, buf[off + 4:off + length]
+    off += (length + 3) & ~3
+
+def _attr(typ: int, payload: bytes) -> bytes:
+  length = 4 + len(payload)
+  return _NLATTR.pack(length, typ) + payload + b'\0' * (-length % 4)
+
+
+class NetlinkBackend:
+  """ Reads peers straight from the kernel via generic netlink (WG_CMD_GET_DEVICE).
+  Needs CAP_NET_ADMIN; `sock_factory` allows swapping the socket out in tests. """
+  name = 'netlink'
+
+  def __init__(self, interface: str, sock_factory=None) -> None:
+    self.interface = interface
+    self._sock_factory = sock_factory or (lambda: socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC))
+    self._family: int | None = None
+    self._seq = 0
+
+  def _request(self, sock, family: int, cmd: int, flags: int, payload: bytes, version: int = 1):
+    self._seq += 1
+    body = _GENLMSGHDR.pack(cmd, version, 0) + payload
+    sock.send(_NLMSGHDR.pack(_NLMSGHDR.size + len(body), family, NLM_F_REQUEST | flags, self._seq, 0) + body)
+    while True:
+      data = memoryview(sock.recv(1 << 20))
+      if not data: return
+      off = 0
+      while off + _NLMSGHDR.size <= len(data):
+        length, typ, _, seq, _ = _NLMSGHDR.unpack_from(data, off)
+        if length < _NLMSGHDR.size: return
+        if typ == NLMSG_DONE: return
+        if typ == NLMSG_ERROR:
+          error = struct.unpack_from('=i', data, off + _NLMSGHDR.size)[0]
+          if error: raise OSError(-error, os.strerror(-error))
+          return
+        yield data[off + _NLMSGHDR.size + _GENLMSGHDR.size:off + length]
+        off += (length + 3) & ~3
+
+  def _resolve_family(self, sock) -> int:
+    if self._family is None:
+      payload = _attr(CTRL_ATTR_FAMILY_NAME, WG_GENL_NAME + b'\0')
+      for msg in self._request(sock, GENL_ID_CTRL, CTRL_CMD_GETFAMILY, NLM_F_ACK, payload):
+        for typ, val in _attrs(msg):
+          if typ == CTRL_ATTR_FAMILY_ID:
+            self._family = struct.unpack_from('=H', val)[0]
+      if self._family is None:
+        raise OSError('wireguard generic netlink family not found')
+    return self._family
+
+  @staticmethod
+  def _endpoint(val: memoryview) -> str | None:
+    family = struct.unpack_from('=H', val)[0]
+    if family == socket.AF_INET:
+      port, = struct.unpack_from('!H', val, 2)
+      return f'{socket.inet_ntop(socket.AF_INET, val[4:8])}:{port}'
+    if family == socket.AF_INET6:
+      port, = struct.unpack_from('!H', val, 2)
+      return _is_endpoint(f'[{socket.inet_ntop(socket.AF_INET6, val[8:24])}]:{port}')
+    return None
+
+  @staticmethod
+  def _allowed_ip(val: memoryview) -> str | None:
+    family = addr = cidr = None
+    for typ, v in _attrs(val):
+      if typ == WGALLOWEDIP_A_FAMILY: family = struct.unpack_from('=H', v)[0]
+      elif typ == WGALLOWEDIP_A_IPADDR: addr = bytes(v)
+      elif typ == WGALLOWEDIP_A_CIDR_MASK: cidr = v[0]
+    if addr is None or cidr is None: return None
+    return f'{socket.inet_ntop(family, addr)}/{cidr}'
+
+  def _peer(self, val: bytes) -> tuple[str | None, dict, list[str]]:
+    pubkey, data, allowed = None, {}, []
+    off, end, unpack = 0, len(val), _NLATTR.unpack_from
+    while off + 4 <= end:
+      length, typ = unpack(val, off)
+      if length < 4: break
+      typ &= NLA_TYPE_MASK
+      start = off + 4
+      if typ == WGPEER_A_PUBLIC_KEY: pubkey = base64.b64encode(val[start:off + length]).decode()
+      elif typ == WGPEER_A_ENDPOINT: data['endpoint'] = self._endpoint(val[start:off + length])
+      elif typ == WGPEER_A_LAST_HANDSHAKE_TIME: data['latest_handshake'] = _S64.unpack_from(val, start)[0]
+      elif typ == WGPEER_A_RX_BYTES: data['received'] = _U64.unpack_from(val, start)[0]
+      elif typ == WGPEER_A_TX_BYTES: data['sent'] = _U64.unpack_from(val, start)[0]
+      elif typ == WGPEER_A_ALLOWEDIPS:
+        allowed.extend(ip for _, a in _attrs(val[start:off + length]) if (ip := self._allowed_ip(a)))
+      off += (length + 3) & ~3
+    return pubkey, data, allowed
+
+  def dump(self) -> list[dict]:
+    sock = self._sock_factory()
+    try:
+      family = self._resolve_family(sock)
+      payload = _attr(WGDEVICE_A_IFNAME, self.interface.encode() + b'\0')
+      peers: dict[str, dict] = {}
+      allowed: dict[str, list[str]] = {}
+      for msg in self._request(sock, family, WG_CMD_GET_DEVICE, NLM_F_DUMP, payload, WG_GENL_VERSION):
+        for typ, val in _attrs(msg):
+          if typ != WGDEVICE_A_PEERS: continue
+          for _, peer in _attrs(val):
+            pubkey, data, ips = self._peer(bytes(peer))
+            if pubkey is None: continue
+            # a peer with many allowed ips may continue in the next message
+            if pubkey in peers: peers[pubkey].update(data)
+            else: peers[pubkey] = data; allowed[pubkey] = []
+            allowed[pubkey].extend(ips)
+    finally:
+      sock.close()
+    return [
+      dict(
+        pubkey=pubkey,
+        endpoint=data.get('endpoint'),
+        allowed_ips=','.join(allowed[pubkey]) or '(none)',
+        latest_handshake=data.get('latest_handshake', 0),
+        received=data.get('received', 0),
+        sent=data.get('sent', 0),
+      ) for pubkey, data in peers.items()
+    ]
+
+  async def peers(self) -> list[dict]:
+    with METRICS.command('netlink dump'):
+      return await asyncio.get_running_loop().run_in_executor(None, self.dump)
+
+
+def get_backend(interface: str, name: str = None):
+  """ STATS_BACKEND: `netlink`, `dump` or `auto` (netlink with dump fallback) """
+  name = name or os.getenv('STATS_BACKEND', 'auto')
+  if name == 'dump': return DumpBackend(interface)
+  return NetlinkBackend(interface)
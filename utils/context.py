@@ -0,0 +1,16 @@
+from __future__ import annotations
+from aiohttp.web import AppKey
+from typing import TYPE_CHECKING
+from .stats import Stats
+from .leader import Leadership
+
+if TYPE_CHECKING:
+  from src.modules import WireGuard, SquidManager, Reconciler, IdleScheduler
+
+STATS = AppKey('stats', Stats)
+LEADER = AppKey('leader', Leadership)
+# the subsystems themselves are imported and created by the app's cleanup contexts
+WG: AppKey[WireGuard] = AppKey('wg')
+SQUID: AppKey[SquidManager] = AppKey('squid')
+RECONCILER: AppKey[Reconciler] = AppKey('reconciler')
+IDLE: AppKey[IdleScheduler] = AppKey('idle')
@@ -0,0 +1,141 @@
+from array import array
+import re
+import os
+
+_RANGE = re.compile(r'^(\d+(?:\.\d+)?)([smhd]?)$')
+_UNITS = dict(s=1, m=60, h=3600, d=86400)
+
+
+def parse_range(value: str) -> float:
+  """ `90`, `30m`, `6h`, `7d` -> seconds """
+  m = _RANGE.match(value.strip().lower())
+  if m is None: raise ValueError(f'Bad range: {value!r}')
+  return float(m.group(1)) * _UNITS[m.group(2) or 's']
+
+
+def history_tiers() -> list[tuple[int, int]]:
+  """ STATS_HISTORY: `<bucket seconds>:<buckets>,...` from finest to coarsest, `off` for none.
+  Every peer preallocates 20 bytes per bucket: the default (an hour by the minute, two days
+  by the hour) is ~2 KB per peer, ~22 MB at 10k peers """
+  spec = os.getenv('STATS_HISTORY', '60:60,3600:48').strip()
+  if spec.lower() in ('', '0', 'off', 'none'): return []
+  return sorted((int(res), int(slots)) for res, slots in (t.split(':') for t in spec.split(',')))
+
+
+class HistoryTier:
+  """ Fixed-size ring of time buckets for every peer.
+  Each peer owns a preallocated block of `slots` entries in flat arrays, so a new bucket
+  is cleared for all peers with one strided slice assignment. """
+  def __init__(self, resolution: int, slots: int) -> None:
+    self.resolution = resolution
+    self.slots = slots
+    self.buckets = array('q', [-1]) * slots
+    self.received = array('Q')
+    self.sent = array('Q')
+    self.handshake = array('I')
+    self.peers = 0
+
+  @property
+  def span(self) -> int:
+    return self.resolution * self.slots
+
+  def grow(self, count: int = 1) -> None:
+    self.received.extend(array('Q', bytes(8 * self.slots * count)))
+    self.sent.extend(array('Q', bytes(8 * self.slots * count)))
+    self.handshake.extend(array('I', bytes(4 * self.slots * count)))
+    self.peers += count
+
+  def clear(self, idx: int) -> None:
+    start, end = idx * self.slots, (idx + 1) * self.slots
+    self.received[start:end] = array('Q', bytes(8 * self.slots))
+    self.sent[start:end] = array('Q', bytes(8 * self.slots))
+    self.handshake[start:end] = array('I', bytes(4 * self.slots))
+
+  def _advance(self, bucket: int) -> int:
+    pos = bucket % self.slots
+    if self.buckets[pos] != bucket:
+      self.buckets[pos] = bucket
+      self.received[pos::self.slots] = array('Q', bytes(8 * self.peers))
+      self.sent[pos::self.slots] = array('Q', bytes(8 * self.peers))
+      self.handshake[pos::self.slots] = array('I', bytes(4 * self.peers))
+    return pos
+
+  def record(self, samples, now: float) -> None:
+    pos = self._advance(int(now // self.resolution))
+    slots, received, sent, handshake = self.slots, self.received, self.sent, self.handshake
+    for idx, rx, tx, hs in samples:
+      at = idx * slots + pos
+      received[at] += rx
+      sent[at] += tx
+      if hs > handshake[at]: handshake[at] = hs
+
+  def series(self, idx: int, since: float) -> tuple[list[int], array, array, array]:
+    """ Buckets of one peer at or after `since`, oldest first """
+    first = int(since // self.resolution)
+    live = sorted((bucket, pos) for pos, bucket in enumerate(self.buckets) if bucket >= first)
+    positions = [pos for _, pos in live]
+    base = idx * self.slots
+    pick = lambda arr: array(arr.typecode, (arr[base + pos] for pos in positions))
+    return [bucket * self.resolution for bucket, _ in live], pick(self.received), pick(self.sent), pick(self.handshake)
+
+
+class PeerHistory:
+  """ In-memory rx/tx/handshake history per peer.
+  Every sample lands in each tier's current bucket, so coarser tiers are the finer ones
+  downsampled (sums for traffic, max for the handshake) and keep proportionally longer ranges. """
+  def __init__(self, tiers: list[tuple[int, int]] = None) -> None:
+    self.tiers = [HistoryTier(res, slots) for res, slots in (tiers or history_tiers())]
+    self.index: dict[str, int] = {}
+    self.free: list[int] = []
+    self.size = 0
+
+  def _slot(self, puid: str) -> int:
+    idx = self.index.get(puid)
+    if idx is None:
+      if self.free:
+        idx = self.free.pop()
+      else:
+        idx = self.size
+        self.size += 1
+      self.index[puid] = idx
+    return idx
+
+  def forget(self, puids) -> None:
+    """ Drops removed peers; their (cleared) blocks go to the next new peers """
+    for puid in puids:
+      idx = self.index.pop(puid, None)
+      if idx is None: continue
+      for tier in self.tiers: tier.clear(idx)
+      self.free.append(idx)
+
+  def record(self, peers: dict[str, dict], now: float) -> None:
+    samples = [
+      (self._slot(puid), stat.get('delta_received') or 0, stat.get('delta_sent') or 0, stat.get('latest_handshake') or 0)
+      for puid, stat in peers.items()
+    ]
+    # new peers get their blocks in one extend, the first sample brings all of them
+    for tier in self.tiers:
+      if self.size > tier.peers: tier.grow(self.size - tier.peers)
+    for tier in self.tiers: tier.record(samples, now)
+
+  def tier_for(self, seconds: float) -> HistoryTier:
+    """ The finest tier that still covers `seconds` """
+    return next((tier for tier in self.tiers if tier.span >= seconds), self.tiers[-1])
+
+  def query(self, puid: str, seconds: float, now: float) -> dict | None:
+    idx = self.index.get(puid)
+    if idx is None: return None
+    tier = self.tier_for(seconds)
+    stamps, received, sent, handshake = tier.series(idx, now - seconds)
+    total_rx, total_tx = sum(received), sum(sent)
+    return dict(
+      resolution=tier.resolution,
+      points=[list(p) for p in zip(stamps, received, sent, handshake)],
+      total_received=total_rx,
+      total_sent=total_tx,
+      peak_received=round(max(received, default=0) / tier.resolution, 2),
+      peak_sent=round(max(sent, default=0) / tier.resolution, 2),
+      avg_received=round(total_rx / (len(stamps) * tier.resolution), 2) if stamps else 0,
+      avg_sent=round(total_tx / (len(stamps) * tier.resolution), 2) if stamps else 0,
+      latest_handshake=max(handshake, default=0),
+    )
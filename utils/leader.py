@@ -0,0 +1,118 @@
+from aiohttp.web import Application, AppRunner, UnixSite, Request, Response, StreamResponse, json_response
+from aiohttp import ClientSession, ClientError, ClientTimeout, UnixConnector
+from .logger import setup_logger
+from typing import Awaitable, Callable
+import asyncio
+import fcntl
+import os
+
+logger = setup_logger('LEADER')
+LOCK_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.wg.leader')
+# request headers the leader gets to see, SSE resumption included
+FORWARD_HEADERS = ('Content-Type', 'Accept', 'Last-Event-ID')
+
+
+class Leadership:
+  """ Picks the one process per host that runs the singleton jobs (reconciling, idle suspends,
+  the access.log state, the address pool rebuild): whoever holds an exclusive flock on `path`.
+  The others retry every `retry` seconds and take the jobs over once the leader exits,
+  the kernel releases the lock with the process.
+  State only the leader keeps is served to the others through `routes`, which the leader
+  answers on a unix socket and `forward` proxies to. """
+  def __init__(self, path: str = None, retry: float = None, routes=(), socket: str = None) -> None:
+    self.path = path or os.getenv('WEB_LEADER_LOCK', LOCK_FILE)
+    self.retry = retry or float(os.getenv('WEB_LEADER_RETRY', 5))
+    self.routes = list(routes)
+    self.socket = socket or os.getenv('WEB_LEADER_SOCKET', f'{self.path}.sock')
+    self.jobs: list[tuple[Callable[..., Awaitable], Callable[..., Awaitable] | None]] = []
+    self.leader = False
+    self._fd: int | None = None
+    self._task: asyncio.Task | None = None
+    self._runner: AppRunner | None = None
+
+  @property
+  def follower(self) -> bool:
+    """ A worker that answers leader-only routes through `forward` """
+    return bool(self.routes) and not self.leader
+
+  def add(self, start: Callable[..., Awaitable], stop: Callable[..., Awaitable] = None) -> None:
+    """ `start(app)` runs when this process becomes the leader, `stop(app)` at shutdown """
+    self.jobs.append((start, stop))
+
+  def _acquire(self) -> bool:
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      os.close(fd)
+      return False
+    os.ftruncate(fd, 0)
+    os.write(fd, f'{os.getpid()}\n'.encode())
+    self._fd = fd
+    return True
+
+  async def _promote(self, app) -> None:
+    self.leader = True
+    logger.info(f'Process {os.getpid()} leads')
+    for start, _ in self.jobs:
+      await start(app)
+    if self.routes: await self._serve(app)
+
+  async def _serve(self, app) -> None:
+    internal = Application()
+    # same state as the public app, without its auth: the socket is private to the user
+    for key in app: internal[key] = app[key]
+    internal.add_routes(self.routes)
+    self._runner = AppRunner(internal, access_log=None)
+    await self._runner.setup()
+    await UnixSite(self._runner, self.socket).start()
+    os.chmod(self.socket, 0o600)
+
+  async def forward(self, req: Request) -> StreamResponse:
+    """ Answers `req` with what the leader answers; event streams are passed on as they come """
+    headers = {name: req.headers[name] for name in FORWARD_HEADERS if name in req.headers}
+    out = None
+    try:
+      # no total timeout, an event stream lasts as long as its client
+      async with ClientSession(connector=UnixConnector(self.socket), timeout=ClientTimeout(total=None, sock_connect=5)) as session:
+        async with session.request(req.method, f'http://leader{req.path_qs}', data=await req.read(), headers=headers) as resp:
+          if resp.content_type != 'text/event-stream':
+            return Response(body=await resp.read(), status=resp.status, content_type=resp.content_type)
+          out = StreamResponse(status=resp.status, headers={
+            name: resp.headers[name] for name in ('Content-Type', 'Cache-Control', 'X-Accel-Buffering') if name in resp.headers
+          })
+          await out.prepare(req)
+          async for chunk in resp.content.iter_any():
+            await out.write(chunk)
+          return out
+    except (ClientError, OSError) as ex:
+      if out is not None: return out
+      return json_response(dict(status='error', message=f'The leader process is unavailable: {ex}'), status=503)
+
+  async def _campaign(self, app) -> None:
+    while not self._acquire():
+      await asyncio.sleep(self.retry)
+    await self._promote(app)
+
+  async def start(self, app) -> None:
+    if self._acquire(): await self._promote(app)
+    else: self._task = asyncio.create_task(self._campaign(app))
+
+  async def stop(self, app) -> None:
+    if self._task is not None:
+      self._task.cancel()
+      try: await self._task
+      except asyncio.CancelledError: pass
+      self._task = None
+    if self._runner is not None:
+      await self._runner.cleanup()
+      self._runner = None
+      try: os.unlink(self.socket)
+      except FileNotFoundError: pass
+    if self.leader:
+      for _, stop in reversed(self.jobs):
+        if stop is not None: await stop(app)
+      self.leader = False
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
@@ -1,32 +1,145 @@
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import threading
 import logging
+import atexit
+import socket
+import queue
+import json
 import os
 
 LOG_FILEPATH=os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', 'logs', 'all.log')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# longer messages are cut when a forked worker sends them to the process owning the file
+LOG_RECORD_MAX = 64 * 1024
+
+
+class JsonFormatter(logging.Formatter):
+  """ One JSON object per line """
+  def format(self, record: logging.LogRecord) -> str:
+    return json.dumps(dict(
+      ts=self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+      level=record.levelname,
+      logger=record.name,
+      msg=record.getMessage(),
+    ), ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+  """ Hands records to the writer thread; when the queue is full the record is counted and dropped """
+  def __init__(self, q: queue.Queue) -> None:
+    super().__init__(q)
+    self.dropped = 0
+
+  def enqueue(self, record: logging.LogRecord) -> None:
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+
+class DrainingQueueListener(QueueListener):
+  """ Waits for room for the stop sentinel so a full queue is still flushed at exit """
+  def enqueue_sentinel(self) -> None:
+    self.queue.put(self._sentinel)
+
+  def stop(self) -> None:
+    if self._thread is not None: super().stop()
+
+
+class ForwardingHandler(logging.Handler):
+  """ Sends records, message already merged, as one datagram each to the process owning the file """
+  def __init__(self, sink: socket.socket) -> None:
+    super().__init__()
+    self.sink = sink
+
+  def emit(self, record: logging.LogRecord) -> None:
+    try:
+      fields = dict(record.__dict__, msg=record.getMessage()[:LOG_RECORD_MAX], args=None, exc_info=None)
+      if record.exc_info: fields['exc_text'] = logging.Formatter().formatException(record.exc_info)
+      self.sink.send(json.dumps(fields, default=str).encode())
+    except Exception:
+      self.handleError(record)
+
+
+_handler: DroppingQueueHandler | None = None
+_listener: DrainingQueueListener | None = None
+_lock = threading.Lock()
+# datagram socket pair set up by `own_log`: workers send on the first, the owner reads the second
+_sink: tuple[socket.socket, socket.socket] | None = None
+
+def _shared_handler() -> DroppingQueueHandler:
+  """ One bounded queue and one background thread writing to one rotating file for every logger """
+  global _handler, _listener
+  if _handler is not None: return _handler
+  with _lock:
+    if _handler is None:
+      check_logs_folder()
+      file_handler = RotatingFileHandler(LOG_FILEPATH, maxBytes=5*1024*1024, backupCount=5)
+      file_handler.setLevel(logging.DEBUG)
+      file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(
+        "%(asctime)s [%(levelname)s] %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S"
+      ))
+      _listener = DrainingQueueListener(queue.Queue(LOG_QUEUE_SIZE), file_handler)
+      _handler = DroppingQueueHandler(_listener.queue)
+      _listener.start()
+      atexit.register(_listener.stop)
+  return _handler
+
+def _receive(source: socket.socket) -> None:
+  while True:
+    try: data = source.recv(LOG_RECORD_MAX * 2)
+    except OSError: return
+    try: _handler.enqueue(logging.makeLogRecord(json.loads(data)))
+    except ValueError: continue
+
+def own_log() -> None:
+  """ Makes this process the only writer of the log file (and the one rotating it): workers it
+  forks afterwards send their records here instead of opening the file themselves """
+  global _sink
+  _shared_handler()
+  if _sink is not None: return
+  _sink = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+  threading.Thread(target=_receive, args=(_sink[1],), name='log-receiver', daemon=True).start()
+
+def _after_fork() -> None:
+  """ A forked worker gets its own queue and writer thread, the parent's thread is not copied.
+  Under `own_log` the thread forwards to the parent rather than writing the file. """
+  global _listener
+  if _handler is None: return
+  # the inherited listener has no thread here, its atexit stop must not wait on it
+  _listener._thread = None
+  _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+  handlers = _listener.handlers
+  if _sink is not None:
+    _sink[1].close()
+    for handler in handlers: handler.close()
+    handlers = (ForwardingHandler(_sink[0]),)
+  _listener = DrainingQueueListener(_handler.queue, *handlers)
+  _listener.start()
+  atexit.register(_listener.stop)
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def dropped() -> int:
+  """ Records lost because the log queue was full """
+  return _handler.dropped if _handler is not None else 0
 
 def setup_logger(name: str = None, console: bool = False) -> logging.Logger:
   """ Sets up and returns a logger with the specified name"""
   logger = logging.getLogger(name)
   logger.setLevel(logging.INFO)
 
-  formatter = logging.Formatter(
-    "%(asctime)s [%(levelname)s] %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S"
-  )
-
-  console_handler = logging.StreamHandler()
-  console_handler.setLevel(logging.ERROR)
-  console_handler.setFormatter(formatter)
-
-  check_logs_folder()
-
-  file_handler = RotatingFileHandler(
-    LOG_FILEPATH, maxBytes=5*1024*1024, backupCount=5
-  )
-  file_handler.setLevel(logging.DEBUG)
-  file_handler.setFormatter(formatter)
+  handler = _shared_handler()
+  if handler not in logger.handlers: logger.addHandler(handler)
 
-  if console: logger.addHandler(console_handler)
-  logger.addHandler(file_handler)
+  if console and not any(type(h) is logging.StreamHandler for h in logger.handlers):
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.ERROR)
+    console_handler.setFormatter(logging.Formatter(
+      "%(asctime)s [%(levelname)s] %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S"
+    ))
+    logger.addHandler(console_handler)
 
   logger.propagate = False
 
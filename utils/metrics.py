@@ -0,0 +1,194 @@
+from contextlib import contextmanager
+from aiohttp.web import Request, middleware
+from bisect import bisect_left
+from pathlib import Path
+from . import logger
+import asyncio
+import json
+import time
+import os
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.wg.metrics')
+log = logger.setup_logger('METRICS')
+
+
+def _labels(names: tuple, values: tuple) -> str:
+  if not names: return ''
+  escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+  return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+class Histogram:
+  """ Cumulative-bucket histogram keyed by label values, Prometheus text format """
+  def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+    self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+    self.series: dict[tuple, list] = {}
+
+  def observe(self, value: float, *labels) -> None:
+    series = self.series.get(labels)
+    if series is None:
+      series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+    series[0][bisect_left(self.buckets, value)] += 1
+    series[1] += value
+
+  @contextmanager
+  def time(self, *labels):
+    start = time.perf_counter()
+    try: yield
+    finally: self.observe(time.perf_counter() - start, *labels)
+
+  def dump(self) -> list:
+    return [[list(values), counts, total] for values, (counts, total) in self.series.items()]
+
+  def render(self, workers: dict[str, list] = None) -> list[str]:
+    """ Own series unlabelled, or those of every worker: `workers` maps a `worker` label to a `dump()` """
+    lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} histogram']
+    sources = {None: self.dump()} if workers is None else workers
+    for worker, series in sources.items():
+      names = self.labels if worker is None else (*self.labels, 'worker')
+      for values, counts, total in series:
+        values = tuple(values) if worker is None else (*values, worker)
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+          cumulative += count
+          lines.append(f'{self.name}_bucket{_labels((*names, "le"), (*values, bound))} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels(names, values)} {total}')
+        lines.append(f'{self.name}_count{_labels(names, values)} {cumulative}')
+    return lines
+
+
+class Metrics:
+  """ Process metrics for /metrics. Per-peer counters are rendered once per stats sample
+  and kept as a ready buffer, so a scrape only re-renders the small histogram part.
+  With several workers (`shared`) each writes its process series to `directory` every
+  `share_interval` seconds and the leader, which answers /metrics, renders all of them
+  with a `worker` label. """
+  def __init__(self, lag_interval: float = None, shared: bool = None, directory: str = None, share_interval: float = None) -> None:
+    self.requests = Histogram('http_request_duration_seconds', 'HTTP request latency', ('method', 'route', 'status'))
+    self.commands = Histogram('external_command_duration_seconds', 'Latency of external commands', ('command',))
+    self.loop_lag = Histogram('event_loop_lag_seconds', 'Event loop scheduling delay', buckets=LATENCY_BUCKETS[:-3])
+    self.lag_interval = lag_interval or float(os.getenv('METRICS_LAG_INTERVAL', 1))
+    self.last_lag = 0.0
+    self.shared = shared if shared is not None else int(os.getenv('WEB_WORKERS', 1)) > 1
+    self.directory = Path(directory or os.getenv('METRICS_DIR', METRICS_DIR))
+    self.share_interval = share_interval or float(os.getenv('METRICS_SHARE_INTERVAL', 5))
+    self._peers: tuple[int, str] | None = None
+    self._task: asyncio.Task | None = None
+    self._share_task: asyncio.Task | None = None
+
+  def command(self, name: str):
+    return self.commands.time(name)
+
+  def _peer_section(self, stats) -> str:
+    if self._peers is not None and self._peers[0] == stats.cursor: return self._peers[1]
+    rows = stats.snapshot.items()
+    lines = []
+    for metric, field, kind, doc in (
+      ('wireguard_peer_received_bytes_total', 'received', 'counter', 'Bytes received from the peer'),
+      ('wireguard_peer_sent_bytes_total', 'sent', 'counter', 'Bytes sent to the peer'),
+      ('wireguard_peer_latest_handshake_seconds', 'latest_handshake', 'gauge', 'Unix time of the latest handshake'),
+    ):
+      lines.append(f'# HELP {metric} {doc}\n# TYPE {metric} {kind}')
+      lines.extend(f'{metric}{{puid="{puid}"}} {stat.get(field) or 0}' for puid, stat in rows)
+    lines.append(f'# HELP wireguard_peers Peers known to the sampler\n# TYPE wireguard_peers gauge\nwireguard_peers {len(stats.snapshot)}')
+    self._peers = (stats.cursor, '\n'.join(lines) + '\n')
+    return self._peers[1]
+
+  def _state(self) -> dict:
+    return dict(
+      dropped=logger.dropped(), last_lag=self.last_lag,
+      requests=self.requests.dump(), commands=self.commands.dump(), loop_lag=self.loop_lag.dump(),
+    )
+
+  def _workers(self) -> dict[str, dict]:
+    """ This process's state and the latest one written by every other live worker """
+    workers = {str(os.getpid()): self._state()}
+    for path in self.directory.glob('*.json'):
+      if path.stem in workers: continue
+      try:
+        os.kill(int(path.stem), 0)
+        workers[path.stem] = json.loads(path.read_text())
+      except ProcessLookupError:
+        # a worker that died without cleaning up
+        path.unlink(missing_ok=True)
+      except (OSError, ValueError):
+        continue
+    return workers
+
+  def _gauge(self, name: str, kind: str, doc: str, workers: dict | None, field: str, own) -> str:
+    lines = [f'# HELP {name} {doc}', f'# TYPE {name} {kind}']
+    if workers is None: lines.append(f'{name} {own}')
+    else: lines.extend(f'{name}{_labels(("worker",), (worker,))} {state[field]}' for worker, state in workers.items())
+    return '\n'.join(lines) + '\n'
+
+  def render(self, stats, squid_users: int = None) -> bytes:
+    parts = [self._peer_section(stats)]
+    if squid_users is not None:
+      parts.append(f'# HELP squid_users Users in the squid passwd file\n# TYPE squid_users gauge\nsquid_users {squid_users}\n')
+    workers = self._workers() if self.shared else None
+    parts.append(self._gauge('log_records_dropped_total', 'counter', 'Log records dropped on a full log queue', workers, 'dropped', logger.dropped()))
+    parts.append(self._gauge('event_loop_lag_last_seconds', 'gauge', 'Latest event loop delay', workers, 'last_lag', self.last_lag))
+    for field, histogram in (('requests', self.requests), ('commands', self.commands), ('loop_lag', self.loop_lag)):
+      series = None if workers is None else {worker: state[field] for worker, state in workers.items()}
+      parts.append('\n'.join(histogram.render(series)) + '\n')
+    return ''.join(parts).encode()
+
+  def _write(self, state: dict) -> None:
+    self.directory.mkdir(parents=True, exist_ok=True)
+    path = self.directory / f'{os.getpid()}.json'
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, path)
+
+  async def _share(self) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+      try:
+        await loop.run_in_executor(None, self._write, self._state())
+      except OSError as ex:
+        log.error(f'Could not share metrics: {ex}')
+      await asyncio.sleep(self.share_interval)
+
+  async def _watch_lag(self) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+      start = loop.time()
+      await asyncio.sleep(self.lag_interval)
+      self.last_lag = max(0.0, loop.time() - start - self.lag_interval)
+      self.loop_lag.observe(self.last_lag)
+
+  async def start(self, app=None) -> None:
+    if self._task is None:
+      self._task = asyncio.create_task(self._watch_lag())
+    if self.shared and self._share_task is None:
+      self._share_task = asyncio.create_task(self._share())
+
+  async def stop(self, app=None) -> None:
+    for task in (self._task, self._share_task):
+      if task is None: continue
+      task.cancel()
+      try: await task
+      except asyncio.CancelledError: pass
+    self._task = self._share_task = None
+    if self.shared: (self.directory / f'{os.getpid()}.json').unlink(missing_ok=True)
+
+
+METRICS = Metrics()
+
+
+@middleware
+async def metrics_middleware(req: Request, handler, *args):
+  start = time.perf_counter()
+  status = 500
+  try:
+    resp = await handler(req)
+    status = resp.status
+    return resp
+  except Exception as ex:
+    status = getattr(ex, 'status', 500)
+    raise
+  finally:
+    resource = req.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    METRICS.requests.observe(time.perf_counter() - start, req.method, route, status)
@@ -1,23 +1,96 @@
 from aiohttp.web import Request, middleware, json_response
 from .logger import setup_logger
+from .metrics import metrics_middleware
+from pathlib import Path
+import hmac
+import time
+import os
 
 logger = setup_logger('MW|AUTH')
 
+
+class TokenFile:
+  """ Accepted bearer tokens, one per line (blank lines and `#` comments ignored).
+  Several lines allow rotating without downtime; the file is re-read when its mtime
+  changes, checked at most every `recheck` seconds. """
+  def __init__(self, path: str, recheck: float = None) -> None:
+    self.path = Path(path)
+    self.recheck = recheck if recheck is not None else float(os.getenv('TOKEN_RECHECK', 1))
+    self.tokens: tuple[bytes, ...] = ()
+    self._mtime = None
+    self._checked = 0.0
+    self._reload()
+
+  def _reload(self) -> None:
+    self._checked = time.monotonic()
+    try:
+      mtime = self.path.stat().st_mtime_ns
+    except FileNotFoundError:
+      logger.error(f'Token file {self.path} is missing, keeping {len(self.tokens)} known tokens')
+      return
+    if mtime == self._mtime: return
+    lines = (line.strip() for line in self.path.read_text(encoding='utf-8').splitlines())
+    self.tokens = tuple(line.encode() for line in lines if line and not line.startswith('#'))
+    self._mtime = mtime
+
+  @property
+  def first(self) -> str | None:
+    return self.tokens[0].decode() if self.tokens else None
+
+  def check(self, token: str) -> bool:
+    if time.monotonic() - self._checked >= self.recheck: self._reload()
+    token = token.encode()
+    # compare against every token so the timing does not reveal which one matched
+    return sum(hmac.compare_digest(token, known) for known in self.tokens) > 0
+
+
+class FailureLog:
+  """ At most `limit` failed-auth lines per `window` seconds, then one summary line """
+  def __init__(self, limit: int = None, window: float = None) -> None:
+    self.limit = limit if limit is not None else int(os.getenv('AUTH_LOG_LIMIT', 10))
+    self.window = window if window is not None else float(os.getenv('AUTH_LOG_WINDOW', 60))
+    self._started = 0.0
+    self._logged = 0
+    self._suppressed = 0
+
+  def __call__(self, message: str) -> None:
+    now = time.monotonic()
+    if now - self._started >= self.window:
+      if self._suppressed:
+        logger.error(f'{self._suppressed} more failed authentications in the last {int(self.window)}s')
+      self._started, self._logged, self._suppressed = now, 0, 0
+    if self._logged < self.limit:
+      self._logged += 1
+      logger.error(message)
+    else:
+      self._suppressed += 1
+
+
+_tokens: TokenFile | None = None
+_log_failure = FailureLog()
+
+def _token_file() -> TokenFile:
+  global _tokens
+  if _tokens is None:
+    from src import settings
+    _tokens = settings.tokens
+  return _tokens
+
+
 @middleware
 async def jwt_middleware(req: Request, handler, *args):
   remote = req.headers.get('X-Forwarded-For')
   auth_header = req.headers.get('Authorization', '')
   if not auth_header.startswith('Bearer '):
-    logger.error(f'Req from {remote} failed authentication. Missing token')
+    _log_failure(f'Req from {remote} failed authentication. Missing token')
     return json_response(data=dict(status='error', message='Missing or invalid Auhtorization Header'), status=401)
 
   token = auth_header.split(' ')[-1]
-  from src import settings
-  if len(token) != 32 or token != settings.SERVER_TOKEN:
-    logger.error(f'Req from {remote} failed authentication. Invalid token')
+  if not _token_file().check(token):
+    _log_failure(f'Req from {remote} failed authentication. Invalid token')
     return json_response(data=dict(status='error', message='Invalid token'), status=401)
-  
+
   return await handler(req)
 
 
-middlewares=[jwt_middleware]
+middlewares=[metrics_middleware, jwt_middleware]
@@ -0,0 +1,58 @@
+from .logger import setup_logger, own_log
+from typing import Callable
+import signal
+import time
+import sys
+import os
+
+logger = setup_logger('PREFORK')
+
+
+def prefork(target: Callable[[], None], workers: int, backoff: float = 1.0) -> None:
+  """ Runs `target` in `workers` forked processes and keeps that many alive until SIGINT or SIGTERM,
+  which is passed on to them. The workers each bind the port with SO_REUSEPORT, so the kernel
+  spreads connections between them, and send their log records here. A worker that exits is
+  replaced, `backoff` seconds later when it did not live that long (a crash loop does not spin). """
+  children: dict[int, float] = {}
+  stopping = False
+
+  def spawn() -> None:
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      code = 0
+      try:
+        target()
+      except SystemExit as ex:
+        code = ex.code if isinstance(ex.code, int) else 1
+      except BaseException:
+        logger.exception(f'Worker {os.getpid()} failed')
+        code = 1
+      sys.exit(code)
+    children[pid] = time.monotonic()
+
+  def shutdown(signum, frame) -> None:
+    nonlocal stopping
+    stopping = True
+    for pid in list(children):
+      try: os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError: pass
+
+  # the supervisor outlives every worker, so it alone writes and rotates the log file
+  own_log()
+  signal.signal(signal.SIGINT, shutdown)
+  signal.signal(signal.SIGTERM, shutdown)
+  for _ in range(workers):
+    spawn()
+  logger.info(f'Started {workers} workers: {", ".join(map(str, children))}')
+  while children:
+    try:
+      pid, status = os.wait()
+    except ChildProcessError:
+      break
+    started = children.pop(pid, None)
+    if started is None or stopping: continue
+    logger.error(f'Worker {pid} exited with {os.waitstatus_to_exitcode(status)}, starting another')
+    if time.monotonic() - started < backoff: time.sleep(backoff)
+    if not stopping: spawn()
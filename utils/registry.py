@@ -0,0 +1,78 @@
+from .store import PeerStore, get_store
+import threading
+
+
+class PeerRegistry:
+  """ Process-wide uuid <-> pubkey map over the peer store.
+  Loaded once, updated in place by WireGuard and re-read only when
+  the store reports an out-of-band change (`PeerStore.version`). """
+  def __init__(self, store: PeerStore = None) -> None:
+    self.store = store if store is not None else get_store()
+    self.storage = self.store.root
+    self._lock = threading.Lock()
+    self._by_uuid: dict[str, str] = {}
+    self._by_pubkey: dict[str, str] = {}
+    self._version = None
+    self._loaded = False
+    self._refresh()
+
+  def _refresh(self) -> None:
+    version = self.store.version()
+    if self._loaded and version == self._version: return
+    with self._lock:
+      if self._loaded and version == self._version: return
+      users = self.store.pubkeys()
+      self._by_uuid = users
+      self._by_pubkey = {pub: uuid for uuid, pub in users.items()}
+      self._version = version
+      self._loaded = True
+
+  def _touch(self) -> None:
+    self._version = self.store.version()
+
+  def pubkey(self, uuid: str) -> str:
+    self._refresh()
+    return self._by_uuid[uuid]
+
+  def uuid(self, pubkey: str) -> str | None:
+    self._refresh()
+    return self._by_pubkey.get(pubkey)
+
+  def add(self, uuid: str, pubkey: str) -> None:
+    with self._lock:
+      old = self._by_uuid.get(uuid)
+      if old: self._by_pubkey.pop(old, None)
+      self._by_uuid[uuid] = pubkey
+      self._by_pubkey[pubkey] = uuid
+      self._touch()
+
+  def remove(self, uuid: str) -> str | None:
+    with self._lock:
+      pubkey = self._by_uuid.pop(uuid, None)
+      if pubkey: self._by_pubkey.pop(pubkey, None)
+      self._touch()
+      return pubkey
+
+  @property
+  def users(self) -> dict[str, str]:
+    """ uuid -> pubkey """
+    self._refresh()
+    return dict(self._by_uuid)
+
+  @property
+  def pubkeys(self) -> dict[str, str]:
+    """ pubkey -> uuid """
+    self._refresh()
+    return dict(self._by_pubkey)
+
+
+_registry: PeerRegistry | None = None
+_registry_lock = threading.Lock()
+
+def get_registry() -> PeerRegistry:
+  global _registry
+  if _registry is None:
+    with _registry_lock:
+      if _registry is None:
+        _registry = PeerRegistry()
+  return _registry
@@ -1,87 +1,201 @@
-from pathlib import Path
+from .registry import get_registry
+from .backends import DumpBackend, get_backend
+from .history import PeerHistory, history_tiers
+from .logger import setup_logger
+from array import array
 import asyncio
-import re
+import json
+import time
 import os
 
+logger = setup_logger('STATS')
+STREAM_FIELDS = ('received', 'sent', 'latest_handshake', 'rate_received', 'rate_sent')
 
-class Stats:
-  def __init__(self):
-    self.interface = os.getenv('INTERFACE')
-    self.storage = Path(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.wg'))
-    self.users = self._get_users()
-    self._WS = re.compile(r"\s+")
-    
-  @staticmethod
-  def _to_int(val: str) -> int:
-    try: return int(val)
-    except Exception: return 0
+
+class PeerSamples:
+  """ Previous counters per peer in flat arrays indexed by a stable peer slot;
+  slots of removed peers are reused """
+  def __init__(self) -> None:
+    self.index: dict[str, int] = {}
+    self.free: list[int] = []
+    self.received = array('Q')
+    self.sent = array('Q')
+    self.handshake = array('q')
+    self.changed = array('Q')
+    self.cursor = 0
+    self.taken_at: float | None = None
 
   @staticmethod
-  def _is_pubkey(token: str) -> bool:
-    if token in ['(none)', 'none', '-']: return False
-    if len(token) < 20: return False
-    return all(c.isalnum() or c in "+/=" for c in token) 
-    
-  def _get_users(self):
-    users = {}
-    for entry in self.storage.iterdir():
-      if entry.is_dir():
-        pubkey_file = entry / 'public.key'
-        if pubkey_file.exists():
-          with open(pubkey_file, 'r') as f:
-            users[f.read().strip()] = entry.name
-    return users
-  
-  def _is_endpoint(self, endpoint: str = None) -> str | None:
-    if not endpoint or endpoint == '(none)': return None
-    if endpoint.count(":") >= 2 and endpoint.startswith("[") and "]:" in endpoint:
-      host = endpoint.split("]:", 1)[0].lstrip("[")
-      port = endpoint.split("]:", 1)[1]
-      endpoint_ip = host.strip()
-      endpoint_port = self._to_int(port.strip())
-      ep = f'{endpoint_ip}:{endpoint_port}'
-    elif ":" in endpoint:
-      host, port = endpoint.rsplit(":", 1)
-      endpoint_ip = host.strip()
-      endpoint_port = self._to_int(port.strip())
-      ep = f'{endpoint_ip}:{endpoint_port}'
-    else:
-      ep = endpoint.strip()
-    return ep
+  def _delta(current: int, previous: int) -> int:
+    # counters restart from zero when the interface is recreated
+    return current - previous if current >= previous else current
+
+  def update(self, peers: dict[str, dict], now: float) -> None:
+    self.cursor += 1
+    elapsed = now - self.taken_at if self.taken_at is not None else 0
+    for puid, stat in peers.items():
+      rx, tx, hs = stat.get('received') or 0, stat.get('sent') or 0, stat.get('latest_handshake') or 0
+      idx = self.index.get(puid)
+      if idx is None:
+        if self.free:
+          idx = self.index[puid] = self.free.pop()
+          self.received[idx], self.sent[idx], self.handshake[idx], self.changed[idx] = rx, tx, hs, self.cursor
+        else:
+          idx = self.index[puid] = len(self.received)
+          self.received.append(rx); self.sent.append(tx); self.handshake.append(hs); self.changed.append(self.cursor)
+        d_rx = d_tx = 0
+      else:
+        d_rx, d_tx = self._delta(rx, self.received[idx]), self._delta(tx, self.sent[idx])
+        if d_rx or d_tx or hs != self.handshake[idx]: self.changed[idx] = self.cursor
+        self.received[idx], self.sent[idx], self.handshake[idx] = rx, tx, hs
+      stat['delta_received'] = d_rx
+      stat['delta_sent'] = d_tx
+      stat['rate_received'] = round(d_rx / elapsed, 2) if elapsed else 0
+      stat['rate_sent'] = round(d_tx / elapsed, 2) if elapsed else 0
+    self.taken_at = now
+
+  def forget(self, puids) -> None:
+    for puid in puids:
+      idx = self.index.pop(puid, None)
+      if idx is not None: self.free.append(idx)
+
+  def changed_since(self, cursor: int) -> set[str]:
+    """ Peers whose counters or handshake moved after `cursor` """
+    if cursor > self.cursor: return set(self.index)
+    changed = self.changed
+    return {puid for puid, idx in self.index.items() if changed[idx] > cursor}
+
+
+class Stats:
+  def __init__(self, interval: float = None):
+    self.interface = os.getenv('INTERFACE')
+    self.registry = get_registry()
+    self.interval = interval or float(os.getenv('STATS_INTERVAL', 5))
+    self.backend_name = os.getenv('STATS_BACKEND', 'auto')
+    self.backend = get_backend(self.interface, self.backend_name)
+    self.snapshot: dict = {}
+    self.sampled_at: float | None = None
+    self._refreshing: asyncio.Future | None = None
+    self._task: asyncio.Task | None = None
+    self.samples = PeerSamples()
+    # kept by the leader process only, see `keep_history`
+    self.history: PeerHistory | None = None
+    self.stream_queue = int(os.getenv('STATS_STREAM_QUEUE', 16))
+    self.subscribers: set[asyncio.Queue] = set()
+    self.dropped = 0
     
   async def _get_wg_stats(self) -> list[dict]:
-    proc = await asyncio.create_subprocess_exec(
-      'sudo', 'wg', 'show', self.interface, 'dump',
-      stdout=asyncio.subprocess.PIPE,
-      stderr=asyncio.subprocess.PIPE
-    )
-    stdout, _ = await proc.communicate()
-    
-    stats = []
-    start_idx = 1
-    lines = [ln.rstrip("\n") for ln in stdout.decode('utf-8', errors='replace').splitlines() if ln.strip()]
-    if not lines: return []
-    for line in lines[start_idx:]:
-      data = {}
-      tokens = self._WS.split(line.strip())
-      if not tokens or not self._is_pubkey(tokens[0]): continue
-      data['pubkey'] = tokens[0] if tokens else None
-      data['endpoint'] = self._is_endpoint(tokens[2]) if len(tokens) > 2 else None
-      data['allowed_ips'] = tokens[3] if len(tokens) > 3 else None
-      data['latest_handshake'] = self._to_int(tokens[4]) if len(tokens) > 3 else None
-      data['received'] = self._to_int(tokens[5]) if len(tokens) > 5 else "0"
-      data['sent'] = self._to_int(tokens[6]) if len(tokens) > 6 else "0"
-      stats.append(data)
-    return stats
+    try:
+      return await self.backend.peers()
+    except OSError as ex:
+      if self.backend_name != 'auto' or isinstance(self.backend, DumpBackend): raise
+      logger.error(f'{self.backend.name} backend unavailable ({ex}), falling back to wg dump')
+      self.backend = DumpBackend(self.interface)
+      return await self.backend.peers()
   
   async def collect_stats(self):
     gathered = {}
     stats = await self._get_wg_stats()
+    users = self.registry.pubkeys
     for stat in stats:
-      puid = self.users[stat.pop('pubkey')]      
+      puid = users.get(stat.pop('pubkey'))
+      if puid is None: continue
       gathered[puid] = stat
+    self.samples.update(gathered, time.monotonic())
+    if self.history is not None: self.history.record(gathered, time.time())
+    self._forget_removed(gathered, users)
     return gathered
 
+  def _forget_removed(self, gathered: dict, users: dict[str, str]) -> None:
+    """ Frees the slots of peers that left the registry """
+    absent = [puid for puid in self.samples.index if puid not in gathered]
+    if not absent: return
+    known = set(users.values())
+    removed = [puid for puid in absent if puid not in known]
+    if not removed: return
+    self.samples.forget(removed)
+    if self.history is not None: self.history.forget(removed)
+
+  @property
+  def cursor(self) -> int:
+    return self.samples.cursor
+
+  def since(self, cursor: int) -> dict:
+    """ Subset of the current snapshot that changed after `cursor` """
+    changed = self.samples.changed_since(cursor)
+    return {puid: stat for puid, stat in self.snapshot.items() if puid in changed}
+
+  @property
+  def age(self) -> float | None:
+    """ Seconds since the current snapshot was taken """
+    if self.sampled_at is None: return None
+    return time.monotonic() - self.sampled_at
+
+  async def _sample(self) -> dict:
+    self.snapshot = await self.collect_stats()
+    self.sampled_at = time.monotonic()
+    if self.subscribers: self._publish(self.frame('delta', self.since(self.cursor - 1)))
+    return self.snapshot
+
+  def frame(self, event: str, peers: dict) -> bytes:
+    """ SSE frame with one row of STREAM_FIELDS per peer, tagged with the sample cursor """
+    rows = {puid: [stat.get(f) for f in STREAM_FIELDS] for puid, stat in peers.items()}
+    return f'id: {self.cursor}\nevent: {event}\ndata: {json.dumps(rows, separators=(",", ":"))}\n\n'.encode()
+
+  def subscribe(self) -> asyncio.Queue:
+    queue = asyncio.Queue(self.stream_queue)
+    self.subscribers.add(queue)
+    return queue
+
+  def unsubscribe(self, queue: asyncio.Queue) -> None:
+    self.subscribers.discard(queue)
+
+  def _publish(self, frame: bytes) -> None:
+    """ Encoded once, shared by every subscriber; one that fell `stream_queue` frames behind is dropped """
+    for queue in list(self.subscribers):
+      try:
+        queue.put_nowait(frame)
+      except asyncio.QueueFull:
+        self.subscribers.discard(queue)
+        self.dropped += 1
+        while not queue.empty(): queue.get_nowait()
+        queue.put_nowait(None)
+
+  def _refresh_done(self, fut: asyncio.Future) -> None:
+    if self._refreshing is fut: self._refreshing = None
+
+  async def refresh(self) -> dict:
+    """ Single-flight resample: concurrent callers share one `wg show dump` """
+    if self._refreshing is None:
+      self._refreshing = asyncio.ensure_future(self._sample())
+      self._refreshing.add_done_callback(self._refresh_done)
+    return await asyncio.shield(self._refreshing)
+
+  async def _run(self) -> None:
+    while True:
+      try:
+        await self.refresh()
+      except asyncio.CancelledError:
+        raise
+      except Exception as ex:
+        logger.error(f'Sampling failed: {ex}')
+      await asyncio.sleep(self.interval)
+
+  async def keep_history(self, app=None) -> None:
+    """ Leader job: the history is the large part of Stats, one process keeps it for all workers """
+    if self.history is None and history_tiers(): self.history = PeerHistory()
+
+  async def start(self, app=None) -> None:
+    if self._task is None:
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self, app=None) -> None:
+    if self._task is None: return
+    self._task.cancel()
+    try: await self._task
+    except asyncio.CancelledError: pass
+    self._task = None
+
 
 def test():
   s = Stats()
@@ -0,0 +1,221 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+import threading
+import sqlite3
+import shutil
+import sys
+import os
+
+STORAGE = Path(os.getenv('WG_STORAGE') or os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '.wg'))
+FIELDS = ('uuid', 'pubkey', 'privkey', 'address', 'allowed_ips')
+
+
+class PeerStore(ABC):
+  """ Peer records: {uuid, pubkey, privkey, address, allowed_ips}.
+  `root` is the directory that also holds the server keys. """
+  root: Path
+
+  @abstractmethod
+  def get(self, uuid: str) -> dict | None: ...
+  def put(self, record: dict) -> None: self.put_many([record])
+  @abstractmethod
+  def put_many(self, records) -> None: ...
+  @abstractmethod
+  def update(self, uuid: str, **fields) -> None: ...
+  @abstractmethod
+  def delete(self, uuid: str) -> None: ...
+  @abstractmethod
+  def items(self): ...
+  @abstractmethod
+  def pubkeys(self) -> dict[str, str]:
+    """ uuid -> pubkey for every peer """
+  @abstractmethod
+  def version(self):
+    """ Changes whenever the store was modified by someone else """
+  def save_config(self, uuid: str, config: str) -> None:
+    pass
+  def close(self) -> None:
+    pass
+
+
+class DirectoryStore(PeerStore):
+  """ Legacy layout: .wg/<uuid>/{private.key, public.key, address, allowed_ips, wg.conf} """
+  FILES = dict(privkey='private.key', pubkey='public.key', address='address', allowed_ips='allowed_ips')
+
+  def __init__(self, root: Path = STORAGE) -> None:
+    self.root = Path(root)
+    self.root.mkdir(parents=True, exist_ok=True)
+
+  @staticmethod
+  def _read(path: Path) -> str | None:
+    try: return path.read_text().strip()
+    except FileNotFoundError: return None
+
+  def _write(self, uuid: str, fields: dict) -> None:
+    folder = self.root / uuid
+    folder.mkdir(parents=True, exist_ok=True)
+    for field, filename in self.FILES.items():
+      if fields.get(field) is not None:
+        (folder / filename).write_text(str(fields[field]))
+
+  def get(self, uuid: str) -> dict | None:
+    folder = self.root / uuid
+    pubkey = self._read(folder / 'public.key')
+    if pubkey is None: return None
+    record = dict(uuid=uuid, pubkey=pubkey)
+    for field in ('privkey', 'address', 'allowed_ips'):
+      record[field] = self._read(folder / self.FILES[field])
+    if record['address'] is None:
+      for line in (self._read(folder / 'wg.conf') or '').splitlines():
+        if line.startswith('Address'):
+          record['address'] = line.split('=', 1)[1].strip().split('/')[0]
+    return record
+
+  def put_many(self, records) -> None:
+    for record in records:
+      self._write(record['uuid'], record)
+
+  def update(self, uuid: str, **fields) -> None:
+    self._write(uuid, fields)
+
+  def delete(self, uuid: str) -> None:
+    shutil.rmtree(self.root / uuid, ignore_errors=True)
+
+  def _uuids(self):
+    with os.scandir(self.root) as entries:
+      return [entry.name for entry in entries if entry.is_dir()]
+
+  def items(self):
+    for uuid in self._uuids():
+      record = self.get(uuid)
+      if record: yield record
+
+  def pubkeys(self) -> dict[str, str]:
+    users = {}
+    for uuid in self._uuids():
+      pubkey = self._read(self.root / uuid / 'public.key')
+      if pubkey: users[uuid] = pubkey
+    return users
+
+  def version(self):
+    try: return os.stat(self.root).st_mtime_ns
+    except FileNotFoundError: return None
+
+  def save_config(self, uuid: str, config: str) -> None:
+    (self.root / uuid).mkdir(parents=True, exist_ok=True)
+    (self.root / uuid / 'wg.conf').write_text(config)
+
+
+class SQLiteStore(PeerStore):
+  """ All peers in one SQLite database in WAL mode, indexed by uuid and pubkey.
+  One connection guarded by a lock, so our own writes do not bump `data_version`. """
+  SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS peers (
+      uuid TEXT PRIMARY KEY,
+      pubkey TEXT NOT NULL UNIQUE,
+      privkey TEXT,
+      address TEXT,
+      allowed_ips TEXT
+    ) WITHOUT ROWID
+  '''
+
+  def __init__(self, path: Path = None, root: Path = STORAGE) -> None:
+    self.root = Path(root)
+    self.root.mkdir(parents=True, exist_ok=True)
+    self.path = Path(path or self.root / 'peers.db')
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute(self.SCHEMA)
+
+  def get(self, uuid: str) -> dict | None:
+    with self._lock:
+      row = self._db.execute(f'SELECT {", ".join(FIELDS)} FROM peers WHERE uuid = ?', (uuid,)).fetchone()
+    return dict(zip(FIELDS, row)) if row else None
+
+  def get_by_pubkey(self, pubkey: str) -> dict | None:
+    with self._lock:
+      row = self._db.execute(f'SELECT {", ".join(FIELDS)} FROM peers WHERE pubkey = ?', (pubkey,)).fetchone()
+    return dict(zip(FIELDS, row)) if row else None
+
+  def put_many(self, records) -> None:
+    rows = [tuple(record.get(f) for f in FIELDS) for record in records]
+    with self._lock:
+      self._db.execute('BEGIN')
+      try:
+        self._db.executemany(f'INSERT OR REPLACE INTO peers ({", ".join(FIELDS)}) VALUES (?, ?, ?, ?, ?)', rows)
+        self._db.execute('COMMIT')
+      except Exception:
+        self._db.execute('ROLLBACK')
+        raise
+
+  def update(self, uuid: str, **fields) -> None:
+    fields = {k: v for k, v in fields.items() if k in FIELDS[1:]}
+    if not fields: return
+    with self._lock:
+      self._db.execute(f'UPDATE peers SET {", ".join(f"{k} = ?" for k in fields)} WHERE uuid = ?', (*fields.values(), uuid))
+
+  def delete(self, uuid: str) -> None:
+    with self._lock:
+      self._db.execute('DELETE FROM peers WHERE uuid = ?', (uuid,))
+
+  def items(self, page: int = 1000):
+    """ Keyset-paged, so walking every peer holds one page in memory """
+    last = ''
+    while True:
+      with self._lock:
+        rows = self._db.execute(f'SELECT {", ".join(FIELDS)} FROM peers WHERE uuid > ? ORDER BY uuid LIMIT ?', (last, page)).fetchall()
+      yield from (dict(zip(FIELDS, row)) for row in rows)
+      if len(rows) < page: return
+      last = rows[-1][0]
+
+  def pubkeys(self) -> dict[str, str]:
+    with self._lock:
+      return dict(self._db.execute('SELECT uuid, pubkey FROM peers'))
+
+  def __len__(self) -> int:
+    with self._lock:
+      return self._db.execute('SELECT COUNT(*) FROM peers').fetchone()[0]
+
+  def version(self):
+    with self._lock:
+      return self._db.execute('PRAGMA data_version').fetchone()[0]
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+
+def migrate(source: PeerStore, target: PeerStore, batch: int = 1000) -> int:
+  """ Copies every peer record from `source` into `target` """
+  count, chunk = 0, []
+  for record in source.items():
+    chunk.append(record)
+    if len(chunk) >= batch:
+      target.put_many(chunk)
+      count, chunk = count + len(chunk), []
+  if chunk:
+    target.put_many(chunk)
+    count += len(chunk)
+  return count
+
+
+def get_store(kind: str = None) -> PeerStore:
+  """ WG_STORE: `sqlite` (default, WG_STORE_PATH or .wg/peers.db) or `dir` (legacy per-peer folders).
+  An empty SQLite store is seeded from the legacy folders on first use. """
+  kind = kind or os.getenv('WG_STORE', 'sqlite')
+  if kind == 'dir': return DirectoryStore()
+  store = SQLiteStore(os.getenv('WG_STORE_PATH'))
+  if not len(store):
+    migrate(DirectoryStore(store.root), store)
+  return store
+
+
+if __name__ == '__main__':
+  # python -m src.utils.store migrate [<dir>] [<db>]
+  if sys.argv[1:2] != ['migrate']:
+    sys.exit('usage: python -m src.utils.store migrate [<dir>] [<db>]')
+  src_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else STORAGE
+  db = Path(sys.argv[3]) if len(sys.argv) > 3 else None
+  print(f'Migrated {migrate(DirectoryStore(src_dir), SQLiteStore(db, root=src_dir))} peers')